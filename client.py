@@ -1,11 +1,17 @@
-from typing import List,Dict,Optional
+from typing import List,Dict,Optional,Iterator,AsyncIterator,Union
 from pydantic import BaseModel,validator
 import requests as R
+import httpx
+import asyncio
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from nanoid import generate as nanoid
 import string
 import os
 from option import Result,Ok,Err
 import json as J
+import time
+from concurrent.futures import ThreadPoolExecutor
 class LevelCatalog(BaseModel):
     level: int
     cid: str
@@ -125,22 +131,61 @@ class Product(BaseModel):
 
 
 
+class ChunkResult(BaseModel):
+    index:int
+    size:int
+    attempts:int = 0
+    ok:bool = False
+    error:str = ""
+
+class BulkRegistrationError(Exception):
+    def __init__(self, chunks:List[ChunkResult]):
+        self.chunks = chunks
+        failed = [chunk for chunk in chunks if not chunk.ok]
+        super().__init__("{} of {} product chunks failed".format(len(failed), len(chunks)))
+
 OBSERVATORY_ID_SIZE = int(os.environ.get("OBSERVATORY_ID_SIZE","12"))
 OBSERVATORY_ID_ALPHABET  = string.ascii_lowercase+string.digits 
 
+OCA_POOL_SIZE = int(os.environ.get("OCA_POOL_SIZE","10"))
+OCA_CONNECT_TIMEOUT = float(os.environ.get("OCA_CONNECT_TIMEOUT","5"))
+OCA_READ_TIMEOUT = float(os.environ.get("OCA_READ_TIMEOUT","60"))
+OCA_MAX_RETRIES = int(os.environ.get("OCA_MAX_RETRIES","3"))
+OCA_BACKOFF_FACTOR = float(os.environ.get("OCA_BACKOFF_FACTOR","0.5"))
+OCA_MAX_CONCURRENCY = int(os.environ.get("OCA_MAX_CONCURRENCY","10"))
+OCA_PAGE_SIZE = int(os.environ.get("OCA_PAGE_SIZE","1000"))
+
 class OCAClient(object):
-    def __init__(self,hostname:str, port:int=-1):
+    def __init__(self,hostname:str, port:int=-1, pool_size:int=OCA_POOL_SIZE,
+                 timeout:tuple=(OCA_CONNECT_TIMEOUT,OCA_READ_TIMEOUT), max_retries:int=OCA_MAX_RETRIES,
+                 backoff_factor:float=OCA_BACKOFF_FACTOR):
         self.base_url = "https://{}".format(hostname) if port == -1 else "http://{}:{}".format(hostname,port)
         self.observatories_url = "{}/observatories".format(self.base_url)
         self.catalogs_url = "{}/catalogs".format(self.base_url)
         self.products_url = "{}/products".format(self.base_url)
+        self.timeout = timeout
+        # Pooled keep-alive session; idempotent methods (GET, DELETE, ...) are retried with exponential
+        # backoff on connection errors and 5xx responses
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=[500,502,503,504],
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = R.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+    def close(self):
+        self.session.close()
     def create_observatory(self, observatory:Observatory)->Result[str,Exception]:
         try:
             if observatory.image_url == "":
                 observatory.image_url = "https://ivoice.live/wp-content/uploads/2019/12/no-image-1.jpg"
             if observatory.obid == "":
                 observatory.obid = nanoid(alphabet=OBSERVATORY_ID_ALPHABET,size=OBSERVATORY_ID_SIZE)
-            response = R.post(self.observatories_url,json=observatory.model_dump())
+            response = self.session.post(self.observatories_url,json=observatory.model_dump(), timeout=self.timeout)
             response.raise_for_status()
             return Ok(observatory.obid)
         except Exception as e:
@@ -149,7 +194,7 @@ class OCAClient(object):
     def delete_observatory(self,obid:str)->Result[str,Exception]:
         url = "{}/{}".format(self.observatories_url,obid)
         try:
-            response = R.delete(url=url)
+            response = self.session.delete(url=url, timeout=self.timeout)
             response.raise_for_status()
             return Ok(obid)
         except Exception as e:
@@ -158,7 +203,7 @@ class OCAClient(object):
         try:
             url = "{}/{}".format(self.observatories_url,obid)
             _catalogs = list(map(lambda x: x.model_dump() , catalogs))
-            response = R.post(url=url, json=_catalogs )
+            response = self.session.post(url=url, json=_catalogs , timeout=self.timeout)
             response.raise_for_status()
             return Ok(obid)
         except Exception as e:
@@ -168,7 +213,7 @@ class OCAClient(object):
     def get_observatory(self,obid:str)->Result[Observatory, Exception]:
         url = "{}/{}".format(self.observatories_url,obid)
         try:
-            response = R.get(url=url)
+            response = self.session.get(url=url, timeout=self.timeout)
             response.raise_for_status()
             data = response.json()
             print(data)
@@ -184,7 +229,7 @@ class OCAClient(object):
     def get_observatories(self,skip:int=0,limit:int=10)->Result[List[Observatory],Exception]:
         try:
             url = "{}?skip={}&limit={}".format(self.observatories_url,skip,limit)
-            response = R.get(url=url)
+            response = self.session.get(url=url, timeout=self.timeout)
             response.raise_for_status()
             data = response.json()
             print(data)
@@ -198,7 +243,7 @@ class OCAClient(object):
             if catalog.cid == "":
                 catalog.cid = nanoid(alphabet=OBSERVATORY_ID_ALPHABET, size=OBSERVATORY_ID_SIZE)
             data = catalog.model_dump()
-            response = R.post(url=self.catalogs_url,json=data)
+            response = self.session.post(url=self.catalogs_url,json=data, timeout=self.timeout)
             response.raise_for_status()
             return Ok(catalog.cid)
         except Exception as e:
@@ -207,7 +252,7 @@ class OCAClient(object):
     def delete_catalog(self,cid:str)->Result[str,Exception]:
         try:
             url = "{}/{}".format(self.catalogs_url,cid)
-            response = R.delete(url=url)
+            response = self.session.delete(url=url, timeout=self.timeout)
             response.raise_for_status()
             return Ok(cid)
         except Exception as e:
@@ -215,7 +260,7 @@ class OCAClient(object):
     def get_catalog(self,cid:str)->Result[Catalog,Exception]:
         try:
             url = "{}/{}".format(self.catalogs_url,cid)
-            response = R.get(url=url)
+            response = self.session.get(url=url, timeout=self.timeout)
             response.raise_for_status()
             data = response.json()
             return Ok(Catalog(**data))
@@ -223,7 +268,7 @@ class OCAClient(object):
             return Err(e)
     def get_catalogs(self)->Result[List[Catalog],Exception]:
         try:
-            response = R.get(url=self.catalogs_url)
+            response = self.session.get(url=self.catalogs_url, timeout=self.timeout)
             response.raise_for_status()
             data = response.json()
             catalogs = list(map(lambda x: Catalog(**x), data))
@@ -233,7 +278,7 @@ class OCAClient(object):
     def get_products(self,skip:int = 0, limit:int = 10)->Result[List[Product],Exception]:
         try:
             url = "{}?skip={}&limit={}".format(self.products_url,skip,limit)
-            response = R.get(url=url)
+            response = self.session.get(url=url, timeout=self.timeout)
             response.raise_for_status()
             data = response.json()
             products = list(map(lambda x : Product(**x), data))
@@ -243,7 +288,7 @@ class OCAClient(object):
     def query_products(self,obid:str, filter:ProductFilter ,skip:int = 0, limit:int = 100 ):
         try:
             url = "{}/{}/products/nid".format(self.observatories_url,obid)
-            response = R.post(url=url, json= filter.model_dump())
+            response = self.session.post(url=url, json= filter.model_dump(), params={"skip":skip,"limit":limit}, timeout=self.timeout)
             response.raise_for_status()
             data = response.json()
             print(data)
@@ -251,19 +296,249 @@ class OCAClient(object):
             return Ok(products)
         except Exception as e:
             return Err(e)
+    def __fetch_products_page(self, skip:int, limit:int)->List[dict]:
+        response = self.session.get(url=self.products_url, params={"skip":skip,"limit":limit}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+    def __fetch_query_page(self, obid:str, filter:ProductFilter, skip:int, limit:int)->List[dict]:
+        url = "{}/{}/products/nid".format(self.observatories_url,obid)
+        response = self.session.post(url=url, json=filter.model_dump(), params={"skip":skip,"limit":limit}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+    def __iter_pages(self, fetch, page_size:int, raw:bool)->Iterator[Union[Product,dict]]:
+        # Walks every page lazily; the next page is requested in the background while the current one is consumed.
+        # Only an empty page marks the end, since the server may cap limit below page_size. An endpoint that ignores
+        # skip returns the same page again, so a page starting with the previous page's first item also ends the walk.
+        # Errors are raised to the caller
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            skip, first = 0, None
+            next_page = executor.submit(fetch, skip, page_size)
+            while next_page is not None:
+                page = next_page.result()
+                if len(page) > 0 and page[0] == first:
+                    break
+                first = page[0] if len(page) > 0 else None
+                skip += len(page)
+                next_page = executor.submit(fetch, skip, page_size) if len(page) > 0 else None
+                for item in page:
+                    yield item if raw else Product(**item)
+    def iter_products(self, page_size:int=OCA_PAGE_SIZE, raw:bool=False)->Iterator[Union[Product,dict]]:
+        return self.__iter_pages(self.__fetch_products_page, page_size, raw)
+    def iter_query_products(self, obid:str, filter:ProductFilter, page_size:int=OCA_PAGE_SIZE, raw:bool=False)->Iterator[Union[Product,dict]]:
+        return self.__iter_pages(lambda skip,limit: self.__fetch_query_page(obid, filter, skip, limit), page_size, raw)
     def create_products(self,products:List[Product]=[])->Result[bool, Exception]:
         try:
             _products = list(map(lambda x : x.model_dump(),products))
-            response = R.post(url=self.products_url,json=_products)
+            response = self.session.post(url=self.products_url,json=_products, timeout=self.timeout)
             response.raise_for_status()
             return Ok(True)
         except Exception as e:
             return Err(e)
+    def create_products_bulk(self,products:List[Product]=[], chunk_size:int=100, max_workers:int=4,
+                             max_attempts:int=3, backoff:float=1.0)->Result[List[ChunkResult],BulkRegistrationError]:
+        chunks = [products[i:i+chunk_size] for i in range(0,len(products),chunk_size)]
+        return self.create_products_chunks(chunks, max_workers=max_workers, max_attempts=max_attempts, backoff=backoff)
+    def create_products_chunks(self,chunks:List[List[Product]]=[], max_workers:int=4,
+                               max_attempts:int=3, backoff:float=1.0)->Result[List[ChunkResult],BulkRegistrationError]:
+        # Registers already split chunks concurrently over the pooled session; only the chunks
+        # that failed are sent again, up to max_attempts times with exponential backoff
+        results = [ChunkResult(index=i, size=len(chunk)) for i,chunk in enumerate(chunks)]
+        pending = list(range(len(chunks)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for attempt in range(1, max_attempts+1):
+                if not pending:
+                    break
+                if attempt > 1:
+                    time.sleep(backoff * 2**(attempt-2))
+                outcomes = list(executor.map(lambda i: self.create_products(chunks[i]), pending))
+                failed = []
+                for i,outcome in zip(pending,outcomes):
+                    results[i].attempts = attempt
+                    results[i].ok = outcome.is_ok
+                    results[i].error = "" if outcome.is_ok else str(outcome.unwrap_err())
+                    if outcome.is_err:
+                        failed.append(i)
+                pending = failed
+        if pending:
+            return Err(BulkRegistrationError(results))
+        return Ok(results)
     def delete_product(self,pid:str)->Result[str,Exception]:
         try:
             url = "{}/{}".format(self.products_url,pid)
-            response = R.delete(url=url)
+            response = self.session.delete(url=url, timeout=self.timeout)
             response.raise_for_status()
             return Ok(pid)
         except Exception as e:
-            return Err(e)
\ No newline at end of file
+            return Err(e)
+
+
+class AsyncOCAClient(object):
+    def __init__(self,hostname:str, port:int=-1, pool_size:int=OCA_POOL_SIZE,
+                 timeout:tuple=(OCA_CONNECT_TIMEOUT,OCA_READ_TIMEOUT), max_retries:int=OCA_MAX_RETRIES,
+                 max_concurrency:int=OCA_MAX_CONCURRENCY):
+        self.base_url = "https://{}".format(hostname) if port == -1 else "http://{}:{}".format(hostname,port)
+        self.observatories_url = "{}/observatories".format(self.base_url)
+        self.catalogs_url = "{}/catalogs".format(self.base_url)
+        self.products_url = "{}/products".format(self.base_url)
+        connect_timeout, read_timeout = timeout
+        # Pooled keep-alive connections shared by every coroutine; connection errors are retried by the
+        # transport and at most max_concurrency requests are in flight at once
+        transport = httpx.AsyncHTTPTransport(retries=max_retries,
+                                             limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+        self.client = httpx.AsyncClient(transport=transport, timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+    async def close(self):
+        await self.client.aclose()
+    async def __aenter__(self)->'AsyncOCAClient':
+        return self
+    async def __aexit__(self, *exc):
+        await self.close()
+    async def __request(self, method:str, url:str, **kwargs)->httpx.Response:
+        async with self.semaphore:
+            response = await self.client.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response
+    async def create_observatory(self, observatory:Observatory)->Result[str,Exception]:
+        try:
+            if observatory.image_url == "":
+                observatory.image_url = "https://ivoice.live/wp-content/uploads/2019/12/no-image-1.jpg"
+            if observatory.obid == "":
+                observatory.obid = nanoid(alphabet=OBSERVATORY_ID_ALPHABET,size=OBSERVATORY_ID_SIZE)
+            await self.__request("POST", self.observatories_url, json=observatory.model_dump())
+            return Ok(observatory.obid)
+        except Exception as e:
+            return Err(e)
+    async def delete_observatory(self,obid:str)->Result[str,Exception]:
+        try:
+            await self.__request("DELETE", "{}/{}".format(self.observatories_url,obid))
+            return Ok(obid)
+        except Exception as e:
+            return Err(e)
+    async def update_observatory_catalogs(self,obid:str, catalogs:List[LevelCatalog]=[])->Result[str,Exception]:
+        try:
+            _catalogs = list(map(lambda x: x.model_dump() , catalogs))
+            await self.__request("POST", "{}/{}".format(self.observatories_url,obid), json=_catalogs)
+            return Ok(obid)
+        except Exception as e:
+            return Err(e)
+    async def get_observatory(self,obid:str)->Result[Observatory, Exception]:
+        try:
+            response = await self.__request("GET", "{}/{}".format(self.observatories_url,obid))
+            data = response.json()
+            return Ok(Observatory(
+                obid= data["obid"],
+                title= data["title"],
+                catalogs=list(map(lambda x: LevelCatalog(**x),data["catalogs"])),
+                description=data["description"],
+                image_url=data["image_url"]
+            ))
+        except Exception as e:
+            return Err(e)
+    async def get_observatories(self,skip:int=0,limit:int=10)->Result[List[Observatory],Exception]:
+        try:
+            response = await self.__request("GET", self.observatories_url, params={"skip":skip,"limit":limit})
+            return Ok(list(map(lambda x: Observatory(**x), response.json())))
+        except Exception as e:
+            return Err(e)
+    async def create_catalog(self,catalog:Catalog)->Result[str,Exception]:
+        try:
+            if catalog.cid == "":
+                catalog.cid = nanoid(alphabet=OBSERVATORY_ID_ALPHABET, size=OBSERVATORY_ID_SIZE)
+            await self.__request("POST", self.catalogs_url, json=catalog.model_dump())
+            return Ok(catalog.cid)
+        except Exception as e:
+            return Err(e)
+    async def delete_catalog(self,cid:str)->Result[str,Exception]:
+        try:
+            await self.__request("DELETE", "{}/{}".format(self.catalogs_url,cid))
+            return Ok(cid)
+        except Exception as e:
+            return Err(e)
+    async def get_catalog(self,cid:str)->Result[Catalog,Exception]:
+        try:
+            response = await self.__request("GET", "{}/{}".format(self.catalogs_url,cid))
+            return Ok(Catalog(**response.json()))
+        except Exception as e:
+            return Err(e)
+    async def get_catalogs(self)->Result[List[Catalog],Exception]:
+        try:
+            response = await self.__request("GET", self.catalogs_url)
+            return Ok(list(map(lambda x: Catalog(**x), response.json())))
+        except Exception as e:
+            return Err(e)
+    async def get_products(self,skip:int = 0, limit:int = 10)->Result[List[Product],Exception]:
+        try:
+            response = await self.__request("GET", self.products_url, params={"skip":skip,"limit":limit})
+            return Ok(list(map(lambda x : Product(**x), response.json())))
+        except Exception as e:
+            return Err(e)
+    async def query_products(self,obid:str, filter:ProductFilter ,skip:int = 0, limit:int = 100 )->Result[List[Product],Exception]:
+        try:
+            url = "{}/{}/products/nid".format(self.observatories_url,obid)
+            response = await self.__request("POST", url, json=filter.model_dump(), params={"skip":skip,"limit":limit})
+            return Ok(list(map(lambda x : Product(**x), response.json())))
+        except Exception as e:
+            return Err(e)
+    async def __iter_pages(self, fetch, page_size:int, raw:bool)->AsyncIterator[Union[Product,dict]]:
+        # Same paging as OCAClient.iter_products; the next page is fetched by a task while the current one is consumed
+        skip, first = 0, None
+        next_page = asyncio.ensure_future(fetch(skip, page_size))
+        try:
+            while next_page is not None:
+                page = (await next_page).json()
+                if len(page) > 0 and page[0] == first:
+                    break
+                first = page[0] if len(page) > 0 else None
+                skip += len(page)
+                next_page = asyncio.ensure_future(fetch(skip, page_size)) if len(page) > 0 else None
+                for item in page:
+                    yield item if raw else Product(**item)
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+    def iter_products(self, page_size:int=OCA_PAGE_SIZE, raw:bool=False)->AsyncIterator[Union[Product,dict]]:
+        return self.__iter_pages(lambda skip,limit: self.__request("GET", self.products_url, params={"skip":skip,"limit":limit}),
+                                 page_size, raw)
+    def iter_query_products(self, obid:str, filter:ProductFilter, page_size:int=OCA_PAGE_SIZE, raw:bool=False)->AsyncIterator[Union[Product,dict]]:
+        url = "{}/{}/products/nid".format(self.observatories_url,obid)
+        return self.__iter_pages(lambda skip,limit: self.__request("POST", url, json=filter.model_dump(), params={"skip":skip,"limit":limit}),
+                                 page_size, raw)
+    async def create_products(self,products:List[Product]=[])->Result[bool, Exception]:
+        try:
+            _products = list(map(lambda x : x.model_dump(),products))
+            await self.__request("POST", self.products_url, json=_products)
+            return Ok(True)
+        except Exception as e:
+            return Err(e)
+    async def create_products_bulk(self,products:List[Product]=[], chunk_size:int=100,
+                                   max_attempts:int=3, backoff:float=1.0)->Result[List[ChunkResult],BulkRegistrationError]:
+        chunks = [products[i:i+chunk_size] for i in range(0,len(products),chunk_size)]
+        return await self.create_products_chunks(chunks, max_attempts=max_attempts, backoff=backoff)
+    async def create_products_chunks(self,chunks:List[List[Product]]=[],
+                                     max_attempts:int=3, backoff:float=1.0)->Result[List[ChunkResult],BulkRegistrationError]:
+        # Same contract as OCAClient.create_products_chunks; chunks are sent concurrently up to max_concurrency
+        results = [ChunkResult(index=i, size=len(chunk)) for i,chunk in enumerate(chunks)]
+        pending = list(range(len(chunks)))
+        for attempt in range(1, max_attempts+1):
+            if not pending:
+                break
+            if attempt > 1:
+                await asyncio.sleep(backoff * 2**(attempt-2))
+            outcomes = await asyncio.gather(*[self.create_products(chunks[i]) for i in pending])
+            failed = []
+            for i,outcome in zip(pending,outcomes):
+                results[i].attempts = attempt
+                results[i].ok = outcome.is_ok
+                results[i].error = "" if outcome.is_ok else str(outcome.unwrap_err())
+                if outcome.is_err:
+                    failed.append(i)
+            pending = failed
+        if pending:
+            return Err(BulkRegistrationError(results))
+        return Ok(results)
+    async def delete_product(self,pid:str)->Result[str,Exception]:
+        try:
+            await self.__request("DELETE", "{}/{}".format(self.products_url,pid))
+            return Ok(pid)
+        except Exception as e:
+            return Err(e)
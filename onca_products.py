@@ -1,18 +1,175 @@
 import pandas as pd
+import numpy as np
 import matplotlib.pyplot as plt
 import plotly.express as px
+import plotly.io as pio
 import json
-import janitor
+import hashlib
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future
+from onca_utils import CONTENT_ENCODINGS, compress_artifact
+
+# GeoJSON leidos por proceso, por (ruta, tolerancia de simplificacion)
+_geojson_cache = {}
+_geojson_lock = threading.RLock()
+
+def load_geojson(file_path: str, tolerance: float = None) -> dict:
+    key = (os.path.abspath(file_path), tolerance)
+    with _geojson_lock:
+        if key not in _geojson_cache:
+            if tolerance is None:
+                with open(file_path, "r") as geojson_file:
+                    _geojson_cache[key] = json.load(geojson_file)
+            else:
+                _geojson_cache[key] = simplify_geojson(load_geojson(file_path), tolerance)
+        return _geojson_cache[key]
+
+def simplify_geojson(geo: dict, tolerance: float) -> dict:
+    # Simplificacion Douglas-Peucker de cada anillo y cuantizacion de coordenadas a la precision de la tolerancia
+    decimals = max(0, int(np.ceil(-np.log10(tolerance))) + 1)
+    features = []
+    for feature in geo["features"]:
+        geometry = feature["geometry"]
+        if geometry["type"] == "Polygon":
+            coordinates = [_simplify_ring(ring, tolerance, decimals) for ring in geometry["coordinates"]]
+        elif geometry["type"] == "MultiPolygon":
+            coordinates = [[_simplify_ring(ring, tolerance, decimals) for ring in polygon]
+                           for polygon in geometry["coordinates"]]
+        else:
+            coordinates = geometry["coordinates"]
+        features.append({**feature, "geometry": {**geometry, "coordinates": coordinates}})
+    return {**geo, "features": features}
+
+def _simplify_ring(ring: list, tolerance: float, decimals: int) -> list:
+    points = np.asarray(ring, dtype=float)
+    keep = _douglas_peucker(points, tolerance)
+    # Un anillo cerrado necesita al menos 4 puntos; si no, solo se cuantiza
+    if keep.sum() >= 4:
+        points = points[keep]
+    return np.round(points, decimals).tolist()
+
+# Valor centinela con el que se construyen las plantillas de figuras
+_TEMPLATE_SENTINEL = "__onca_plantilla__"
+
+def _replace_sentinel(value, sentinel: str, replacement: str):
+    if isinstance(value, str):
+        return value.replace(sentinel, replacement)
+    if isinstance(value, dict):
+        return {k: _replace_sentinel(v, sentinel, replacement) for k, v in value.items()}
+    return value
+
+def _douglas_peucker(points: np.ndarray, tolerance: float) -> np.ndarray:
+    keep = np.zeros(len(points), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end <= start + 1:
+            continue
+        segment = points[end, :2] - points[start, :2]
+        offsets = points[start + 1:end, :2] - points[start, :2]
+        length = np.hypot(segment[0], segment[1])
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+        index = int(np.argmax(distances))
+        if distances[index] > tolerance:
+            split = start + 1 + index
+            keep[split] = True
+            stack.extend([(start, split), (split, end)])
+    return keep
 
 class ProductGenerator:
-    def create_lineplot(self, data: pd.DataFrame, x: str, y: str, color: str, output_path: str,
-                        cie10: str, place: str, scale: str, hover_data: list, labels:dict, cve_geo: str, sex: str, ages: str) -> dict:
-        
-        min_year = data[x].min()
-        max_year = data[x].max()
+    def __init__(self, geojson_tolerance: float = None, plotlyjs_url: str = None, use_templates: bool = False,
+                 in_memory: bool = False, write_files: bool = True, content_encoding: str = None) -> None:
+        # Tolerancia (en grados) para simplificar la geometria de los mapas; None usa la geometria original
+        self.__geojson_tolerance = geojson_tolerance
+        # None incrusta plotly.js en cada HTML; "cdn" usa el CDN de plotly; cualquier otra URL
+        # referencia un plotly.js compartido (p. ej. el subido una vez al bucket con upload_plotlyjs)
+        self.__plotlyjs_url = plotlyjs_url
+        # Reutiliza una figura base por familia de producto y solo reemplaza datos y titulo
+        self.__use_templates = use_templates
+        self.__templates = {}
+        self.__templates_lock = threading.Lock()
+        # in_memory devuelve el HTML y el CSV en la respuesta ("html", "csv") para subirlos sin releerlos del disco;
+        # write_files=False omite la copia local
+        if not in_memory and not write_files:
+            raise ValueError("in_memory=False y write_files=False: el generador no produciria ningun artefacto")
+        self.__in_memory = in_memory
+        self.__write_files = write_files
+        # "gzip" o "br" precomprime el HTML y el CSV (archivos .gz/.br) para servirlos tal cual
+        if content_encoding is not None and content_encoding not in CONTENT_ENCODINGS:
+            raise ValueError(f"Codificacion de contenido no soportada: {content_encoding}")
+        self.__content_encoding = content_encoding
 
-        # fig_title = f"{place} age-specific rate per {scale} inhabitants, {sex}"
-        fig_title = f"{place}, tasa de mortalidad específica por edad por cada {scale} habitantes, {sex.lower()}, edades[{ages}], en {min_year}-{max_year}"
+    def load_geojson(self, geojson_file_path: str) -> dict:
+        return load_geojson(geojson_file_path, self.__geojson_tolerance)
+
+    def __render_html(self, fig) -> str:
+        # fig puede ser una figura de plotly o un diccionario ya armado desde una plantilla
+        if self.__plotlyjs_url is None:
+            return pio.to_html(fig, full_html=True, validate=False)
+        elif self.__plotlyjs_url == "cdn":
+            return pio.to_html(fig, include_plotlyjs="cdn", full_html=True, validate=False)
+        html = pio.to_html(fig, include_plotlyjs=False, full_html=True, validate=False)
+        return html.replace("</head>", f'<script src="{self.__plotlyjs_url}" charset="utf-8"></script></head>', 1)
+
+    def __write_artifacts(self, fig, data: pd.DataFrame, file_path: str) -> dict:
+        artifacts = {"html": self.__render_html(fig).encode("utf-8"),
+                     "csv": data.to_csv(index=False).encode("utf-8")}
+        suffix = ""
+        if self.__content_encoding is not None:
+            artifacts = {extension: compress_artifact(content, self.__content_encoding) for extension, content in artifacts.items()}
+            suffix = CONTENT_ENCODINGS[self.__content_encoding]
+        if self.__write_files:
+            for extension, content in artifacts.items():
+                with open(f"{file_path}.{extension}{suffix}", "wb") as artifact_file:
+                    artifact_file.write(content)
+        response = artifacts if self.__in_memory else {}
+        if self.__content_encoding is not None:
+            response = {**response, "content_encoding": self.__content_encoding}
+        return response
+
+    def __template(self, key: tuple, columns: list, value: str, build) -> dict:
+        # Figura base por familia de producto, construida una sola vez con plotly express sobre una fila centinela
+        with self.__templates_lock:
+            if key not in self.__templates:
+                fig = build(pd.DataFrame({column: [0.0] if column == value else [_TEMPLATE_SENTINEL + column]
+                                          for column in columns}))
+                data = [trace.to_plotly_json() for trace in fig.data]
+                # Columnas que plotly express puso en customdata, recuperadas de los valores centinela
+                customdata = [cell.replace(_TEMPLATE_SENTINEL, "", 1) if isinstance(cell, str) else value
+                              for cell in data[0]["customdata"][0]] if data[0].get("customdata") is not None else []
+                self.__templates[key] = {"data": data,
+                                         "layout": fig.layout.to_plotly_json(),
+                                         "colorway": list(fig.layout.template.layout.colorway),
+                                         "customdata": customdata}
+            return self.__templates[key]
+
+    def __template_layout(self, template: dict, fig_title: str) -> dict:
+        layout = dict(template["layout"])
+        layout["title"] = {**layout.get("title", {}), "text": fig_title}
+        return layout
+
+    def __grouped_traces(self, template: dict, data: pd.DataFrame, color: str, columns: dict, color_property: str) -> list:
+        # Una traza por valor de color, en orden de aparicion y con la paleta ciclica de plotly express
+        colorway = template["colorway"]
+        traces = []
+        for k, (value, group) in enumerate(data.groupby(color, sort=False, observed=True)):
+            trace = _replace_sentinel(template["data"][0], _TEMPLATE_SENTINEL + color, str(value))
+            for attribute, column in columns.items():
+                trace[attribute] = group[column].to_numpy()
+            if template["customdata"]:
+                trace["customdata"] = group[template["customdata"]].to_numpy()
+            trace[color_property] = {**trace[color_property], "color": colorway[k % len(colorway)]}
+            traces.append(trace)
+        return traces
+
+    def __lineplot_figure(self, data: pd.DataFrame, x: str, y: str, color: str, hover_data: list,
+                          labels: dict, scale: str, fig_title: str):
         fig = px.line(data.sort_values([color,x]),
                         x=x,
                         y=y,
@@ -41,13 +198,39 @@ class ProductGenerator:
             )
         )
 
+        return fig
+
+    def __lineplot_from_template(self, data: pd.DataFrame, x: str, y: str, color: str, hover_data: list,
+                                 labels: dict, scale: str, fig_title: str) -> dict:
+        template = self.__template(("lineplot", x, y, color, tuple(hover_data), tuple(labels.items()), scale),
+                                   [x, y, color] + list(hover_data), y,
+                                   lambda frame: self.__lineplot_figure(frame, x, y, color, hover_data, labels, scale, _TEMPLATE_SENTINEL))
+        traces = self.__grouped_traces(template, data.sort_values([color,x]), color,
+                                       {"x": x, "y": y, "hovertext": color}, "line")
+        years = data.sort_values(x)[x].unique()
+        layout = self.__template_layout(template, fig_title)
+        layout["xaxis"] = {**layout["xaxis"], "tickvals": years, "ticktext": years}
+        return {"data": traces, "layout": layout}
+
+    def create_lineplot(self, data: pd.DataFrame, x: str, y: str, color: str, output_path: str,
+                        cie10: str, place: str, scale: str, hover_data: list, labels:dict, cve_geo: str, sex: str, ages: str) -> dict:
+        
+        min_year = data[x].min()
+        max_year = data[x].max()
+
+        # fig_title = f"{place} age-specific rate per {scale} inhabitants, {sex}"
+        fig_title = f"{place}, tasa de mortalidad específica por edad por cada {scale} habitantes, {sex.lower()}, edades[{ages}], en {min_year}-{max_year}"
+        if self.__use_templates:
+            fig = self.__lineplot_from_template(data, x, y, color, hover_data, labels, scale, fig_title)
+        else:
+            fig = self.__lineplot_figure(data, x, y, color, hover_data, labels, scale, fig_title)
+
         # age_groups = data.sort_values(color)[color].unique()
         # min_age = age_groups[0].split("_")[0]
         # max_age = age_groups[-1].split("_")[-1]
         # file_name = f"lineplot_{cie10}_" + f"[{min_year}-{max_year}]_" + f"{cve_geo}_" + sex.replace(" ","") + "_" + f"[{min_age}-{max_age}]_" + y.lower().replace('_', '')
         file_name = f"lineplot_{cie10}_" + f"[{min_year}-{max_year}]_" + f"{cve_geo}_" + sex.replace(" ","") + "_" + f"[{ages}]_" + y.lower().replace('_', '')
-        fig.write_html(output_path + "/" + file_name + ".html")
-        data[[x,color,y]].to_csv(output_path + "/" + file_name + ".csv", index=False)
+        artifacts = self.__write_artifacts(fig, data[[x,color,y]], output_path + "/" + file_name)
         
         # self.__write_metadata(
         #                 name=output_path + "/" + file_name,
@@ -68,17 +251,11 @@ class ProductGenerator:
                 # "rango_edad": f"{min_age}-{max_age}",
         return {"fname": f"{output_path}/{file_name}",
                 "rango_edad": ages,
-                "description": fig_title}
-        
-    def create_state_map(self, data: pd.DataFrame, geojson_file_path: str, x: str, y: str, output_path: str,
-                        cie10: str, place: str, rate: str, scale: str, hover_data: list, labels: dict,
-                        cve_geo: str, sex: str, ages: str, year: str) -> None:
-
-        # fig_title = f"{rate} per {scale} inhabitants, {place}, {sex}, age[{ages}], in {year}"
-        fig_title = f"{place}, {rate} por cada {scale} habitantes, {sex.lower()}, edades[{ages}], en {year}"
+                "description": fig_title,
+                **artifacts}
         
-        geo = json.load(open(geojson_file_path,"r"))
-
+    def __state_map_figure(self, data: pd.DataFrame, geo: dict, x: str, y: str, hover_data: list,
+                           labels: dict, fig_title: str):
         fig = px.choropleth_mapbox(data, geojson=geo, locations=x, 
                                 featureidkey="properties.CVE_ENT",
                                 color=y,
@@ -90,11 +267,36 @@ class ProductGenerator:
                                 center={"lat":22.3969, "lon": -101.2833},
                                 opacity=0.5,
                                 title=fig_title)
+        return fig
+
+    def __state_map_from_template(self, data: pd.DataFrame, geojson_file_path: str, geo: dict, x: str, y: str,
+                                  hover_data: list, labels: dict, fig_title: str) -> dict:
+        template = self.__template(("state_map", geojson_file_path, x, y, tuple(hover_data), tuple(labels.items())),
+                                   [x, y] + list(hover_data), y,
+                                   lambda frame: self.__state_map_figure(frame, geo, x, y, hover_data, labels, _TEMPLATE_SENTINEL))
+        # El geojson de la plantilla se comparte entre trazas sin copiarse
+        trace = {**template["data"][0], "locations": data[x].to_numpy(), "z": data[y].to_numpy()}
+        if template["customdata"]:
+            trace["customdata"] = data[template["customdata"]].to_numpy()
+        return {"data": [trace], "layout": self.__template_layout(template, fig_title)}
+
+    def create_state_map(self, data: pd.DataFrame, geojson_file_path: str, x: str, y: str, output_path: str,
+                        cie10: str, place: str, rate: str, scale: str, hover_data: list, labels: dict,
+                        cve_geo: str, sex: str, ages: str, year: str) -> None:
+
+        # fig_title = f"{rate} per {scale} inhabitants, {place}, {sex}, age[{ages}], in {year}"
+        fig_title = f"{place}, {rate} por cada {scale} habitantes, {sex.lower()}, edades[{ages}], en {year}"
+        
+        geo = self.load_geojson(geojson_file_path)
+
+        if self.__use_templates:
+            fig = self.__state_map_from_template(data, geojson_file_path, geo, x, y, hover_data, labels, fig_title)
+        else:
+            fig = self.__state_map_figure(data, geo, x, y, hover_data, labels, fig_title)
 
         file_name = f"states_map_{cie10}_" + f"{year}_" + f"{cve_geo}_" + sex.replace(" ","") + "_" + f"[{ages}]_" \
             + y.lower().replace('_', '').replace('(','').replace(')','')
-        fig.write_html(output_path + "/" + file_name + ".html")
-        data[hover_data].to_csv(output_path + "/" + file_name + ".csv", index=False)
+        artifacts = self.__write_artifacts(fig, data[hover_data], output_path + "/" + file_name)
         # self.__write_metadata(
         #                 name=output_path + "/" + file_name,
         #                 description="Mapa de tasas de mortalidad por estado.",
@@ -112,7 +314,8 @@ class ProductGenerator:
         del(fig)
         return {"fname": f"{output_path}/{file_name}",
                 "rango_edad": ages,
-                "description": fig_title}
+                "description": fig_title,
+                **artifacts}
 
     def create_municipality_map(self, data: pd.DataFrame, geojson_file_path: str, x: str, y: str, output_path: str,
                         cie10: str, place: str, rate: str, scale: str, hover_data: list, labels: dict,
@@ -120,7 +323,7 @@ class ProductGenerator:
 
         fig_title = f"{rate} per {scale} inhabitants, {place}, {sex}, age[{ages}], in {year}"
         
-        geo = json.load(open(geojson_file_path,"r"))
+        geo = self.load_geojson(geojson_file_path)
 
         fig = px.choropleth_map(data, geojson=geo, locations=x, 
                                 featureidkey="properties.CVEGEO",
@@ -128,7 +331,7 @@ class ProductGenerator:
                                 hover_data=hover_data,
                                 labels=labels,
                                 color_continuous_scale="YlOrRd",
-                                mapbox_style="carto-positron",
+                                map_style="carto-positron",
                                 zoom=4,
                                 center={"lat":22.3969, "lon": -101.2833},
                                 opacity=0.5,
@@ -136,8 +339,7 @@ class ProductGenerator:
         
         file_name = f"municipalities_map_{cie10}_" + f"{year}_" + f"{cve_geo}_" + \
             sex.replace(" ","") + "_" + y.lower().replace('_', '')
-        fig.write_html(output_path + "/" + file_name + ".html")
-        data[hover_data].to_csv(output_path + "/" + file_name + ".csv", index=False)
+        artifacts = self.__write_artifacts(fig, data[hover_data], output_path + "/" + file_name)
         # self.__write_metadata(
         #                 name=output_path + "/" + file_name,
         #                 description="Mapa de tasas de mortalidad por municipio.",
@@ -152,14 +354,13 @@ class ProductGenerator:
         #                 title=fig_title,
         #                 x_axis=x,
         #                 y_axis=y)
+        del(fig)
+        return {"fname": f"{output_path}/{file_name}",
+                "rango_edad": ages,
+                "description": fig_title,
+                **artifacts}
 
-    def create_age_specific_heatmap(self, data: pd.DataFrame, x: str, y: str, z: str, output_path: str,
-                        cie10: str, place: str, rate: str, scale: str, labels: dict,
-                        cve_geo: str, sex: str, ages: str, year: str) -> None:
-
-        # fig_title = f"{rate} per {scale} inhabitants, {place}, {sex}, age[{ages}], in {year}"
-        fig_title = f"{place}, tasa de mortalidad específica por edad por cada {scale} habitantes, {sex.lower()}, edades[{ages}], en {year}"
-
+    def __heatmap_figure(self, data: pd.DataFrame, x: str, y: str, z: str, rate: str, labels: dict, fig_title: str):
         fig = px.density_heatmap(data.round(2), 
                                 x=x, 
                                 y=y, 
@@ -179,9 +380,29 @@ class ProductGenerator:
             coloraxis_colorbar_title_text = rate
         )
         fig.update_yaxes(autorange="reversed")
+        return fig
+
+    def __heatmap_from_template(self, data: pd.DataFrame, x: str, y: str, z: str, rate: str,
+                                labels: dict, fig_title: str) -> dict:
+        template = self.__template(("heatmap", x, y, z, rate, tuple(labels.items())), [x, y, z], z,
+                                   lambda frame: self.__heatmap_figure(frame, x, y, z, rate, labels, _TEMPLATE_SENTINEL))
+        data = data.round(2)
+        trace = {**template["data"][0], "x": data[x].to_numpy(), "y": data[y].to_numpy(), "z": data[z].to_numpy()}
+        return {"data": [trace], "layout": self.__template_layout(template, fig_title)}
+
+    def create_age_specific_heatmap(self, data: pd.DataFrame, x: str, y: str, z: str, output_path: str,
+                        cie10: str, place: str, rate: str, scale: str, labels: dict,
+                        cve_geo: str, sex: str, ages: str, year: str) -> None:
+
+        # fig_title = f"{rate} per {scale} inhabitants, {place}, {sex}, age[{ages}], in {year}"
+        fig_title = f"{place}, tasa de mortalidad específica por edad por cada {scale} habitantes, {sex.lower()}, edades[{ages}], en {year}"
+
+        if self.__use_templates:
+            fig = self.__heatmap_from_template(data, x, y, z, rate, labels, fig_title)
+        else:
+            fig = self.__heatmap_figure(data, x, y, z, rate, labels, fig_title)
         file_name = f"age_specific_heatmap_{cie10}_" + f"{year}_" + f"{cve_geo}_" + sex.replace(" ","") + "_" + f"[{ages}]_" + z.lower().replace('_', '')
-        fig.write_html(output_path + "/" + file_name + ".html")
-        data.to_csv(output_path + "/" + file_name + ".csv", index=False)
+        artifacts = self.__write_artifacts(fig, data, output_path + "/" + file_name)
         # self.__write_metadata(
         #                 name=output_path + "/" + file_name,
         #                 description="Mapa de calor con tasas de mortalidad especificas por edad.",
@@ -200,15 +421,11 @@ class ProductGenerator:
 
         return {"fname": f"{output_path}/{file_name}",
                 "rango_edad": ages,
-                "description": fig_title}
+                "description": fig_title,
+                **artifacts}
         
-    def create_boxplot(self, data: pd.DataFrame, x: str, y: str, color: str, hover_data: list, output_path: str,
-                        cie10: str, place: str, rate: str, scale: str, labels: dict,
-                        cve_geo: str, sex: str, ages: str, year: str) -> None:
-
-        # fig_title = f"{rate} per {scale} inhabitants, {place}, {sex}, age[{ages}], in {year}"
-        fig_title = f"{place}, {rate} por cada {scale} habitantes, {sex.lower()}, edades[{ages}], en {year}"
-
+    def __boxplot_figure(self, data: pd.DataFrame, x: str, y: str, color: str, hover_data: list,
+                         rate: str, scale: str, labels: dict, fig_title: str):
         fig = px.box(data,
              x=x,
              y=y,
@@ -225,10 +442,30 @@ class ProductGenerator:
             # xaxis_title="Age"
             xaxis_title="Grupo de edad"
         )
-        
+        return fig
+
+    def __boxplot_from_template(self, data: pd.DataFrame, x: str, y: str, color: str, hover_data: list,
+                                rate: str, scale: str, labels: dict, fig_title: str) -> dict:
+        template = self.__template(("boxplot", x, y, color, tuple(hover_data), rate, scale, tuple(labels.items())),
+                                   [x, y, color] + list(hover_data), y,
+                                   lambda frame: self.__boxplot_figure(frame, x, y, color, hover_data, rate, scale, labels, _TEMPLATE_SENTINEL))
+        traces = self.__grouped_traces(template, data, color, {"x": x, "y": y}, "marker")
+        return {"data": traces, "layout": self.__template_layout(template, fig_title)}
+
+    def create_boxplot(self, data: pd.DataFrame, x: str, y: str, color: str, hover_data: list, output_path: str,
+                        cie10: str, place: str, rate: str, scale: str, labels: dict,
+                        cve_geo: str, sex: str, ages: str, year: str) -> None:
+
+        # fig_title = f"{rate} per {scale} inhabitants, {place}, {sex}, age[{ages}], in {year}"
+        fig_title = f"{place}, {rate} por cada {scale} habitantes, {sex.lower()}, edades[{ages}], en {year}"
+
+        if self.__use_templates:
+            fig = self.__boxplot_from_template(data, x, y, color, hover_data, rate, scale, labels, fig_title)
+        else:
+            fig = self.__boxplot_figure(data, x, y, color, hover_data, rate, scale, labels, fig_title)
+
         file_name = f"age_specific_boxplot_{cie10}_" + f"{year}_" + f"{cve_geo}_" + sex.replace(" ","") + "_" + f"[{ages}]_" + y.lower().replace('_', '')
-        fig.write_html(output_path + "/" + file_name + ".html")
-        data.to_csv(output_path + "/" + file_name + ".csv", index=False)
+        artifacts = self.__write_artifacts(fig, data, output_path + "/" + file_name)
         # self.__write_metadata(
         #                 name=output_path + "/" + file_name,
         #                 description="Boxplot con tasas de mortalidad especificas por edad.",
@@ -246,7 +483,8 @@ class ProductGenerator:
 
         return {"fname": f"{output_path}/{file_name}",
                 "rango_edad": ages,
-                "description": fig_title}
+                "description": fig_title,
+                **artifacts}
 
     def __write_metadata(self,
                         name='Default',
@@ -300,3 +538,171 @@ class ProductGenerator:
             return f"Country(Mexico)->State({cve_geo})"
         elif len(cve_geo) > 2:
             return f"State({cve_geo[:2]})->Municipality({cve_geo[2:]})"
+
+# Generador de productos de cada proceso del pool de renderizado, creado una sola vez por proceso
+_worker_generator = None
+
+def _init_render_worker(generator_options: dict, geojson_paths: list) -> None:
+    global _worker_generator
+    _worker_generator = ProductGenerator(**generator_options)
+    for geojson_path in geojson_paths:
+        _worker_generator.load_geojson(geojson_path)
+
+def _render_product(method: str, options: dict) -> dict:
+    return getattr(_worker_generator, method)(**options)
+
+class ProductRenderPool:
+    # Renderiza productos en procesos (plotly es Python puro y un pool de hilos no pasa de un nucleo).
+    # Cada proceso conserva su GeoJSON y sus plantillas de figuras entre productos; solo viajan los datos de cada producto.
+    def __init__(self, workers: int, geojson_paths: list = [], **generator_options) -> None:
+        # forkserver: los procesos no heredan los hilos del cliente de MictlanX ni del registro en el OCA (ni sus locks);
+        # el inicializador reconstruye todo el estado del proceso
+        self.__executor = ProcessPoolExecutor(max_workers=workers,
+                                              mp_context=multiprocessing.get_context("forkserver"),
+                                              initializer=_init_render_worker,
+                                              initargs=(generator_options, list(geojson_paths)))
+
+    def submit(self, method: str, **options) -> Future:
+        return self.__executor.submit(_render_product, method, options)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.__executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.shutdown()
+
+class RenderCache:
+    # Cache de renderizado en disco: hash de los datos y parametros de cada producto -> hash de sus artefactos.
+    # Un producto cuyo hash ya esta registrado no se vuelve a renderizar ni a subir
+    def __init__(self, file_path: str, salt: dict = {}) -> None:
+        self.__file_path = file_path
+        # Parametros del generador que cambian los artefactos (URL de plotly.js, compresion, ...)
+        self.__salt = json.dumps(salt, sort_keys=True, default=str)
+        self.__lock = threading.Lock()
+        self.__entries = {}
+        self.__pending = {}
+        self.__hits = 0
+        if os.path.exists(file_path):
+            with open(file_path, "r") as cache_file:
+                self.__entries = json.load(cache_file)
+
+    @property
+    def hits(self) -> int:
+        return self.__hits
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def key(self, method: str, options: dict) -> str:
+        sha = hashlib.sha256(self.__salt.encode("utf-8"))
+        sha.update(method.encode("utf-8"))
+        for name in sorted(options):
+            value = options[name]
+            sha.update(name.encode("utf-8"))
+            if isinstance(value, pd.DataFrame):
+                sha.update(json.dumps([list(map(str, value.columns)), list(map(str, value.dtypes))]).encode("utf-8"))
+                sha.update(pd.util.hash_pandas_object(value, index=False).to_numpy().tobytes())
+            else:
+                sha.update(repr(value).encode("utf-8"))
+        return sha.hexdigest()
+
+    def lookup(self, key: str) -> bool:
+        with self.__lock:
+            if key in self.__entries:
+                self.__hits += 1
+                return True
+            return False
+
+    def record(self, key: str, response: dict) -> None:
+        # Queda pendiente hasta confirm(), una vez que los artefactos se subieron y registraron, o hasta forget() si fallaron
+        sha = hashlib.sha256()
+        for artifact in ("html", "csv"):
+            if artifact in response:
+                sha.update(response[artifact])
+        with self.__lock:
+            self.__pending[key] = {"fname": response.get("fname"),
+                                   "artifact_sha256": sha.hexdigest() if "html" in response else None}
+
+    def confirm(self, key: str) -> None:
+        with self.__lock:
+            if key in self.__pending:
+                self.__entries[key] = self.__pending.pop(key)
+
+    def forget(self, key: str) -> None:
+        with self.__lock:
+            self.__pending.pop(key, None)
+
+    def save(self) -> None:
+        # Solo se guardan las entradas confirmadas
+        with self.__lock:
+            tmp_path = self.__file_path + ".tmp"
+            with open(tmp_path, "w") as cache_file:
+                json.dump(self.__entries, cache_file)
+            os.replace(tmp_path, self.__file_path)
+
+class RenderScheduler:
+    # Planificador de larga vida para todas las etapas: limita los productos en vuelo y entrega cada
+    # resultado a su callback en cuanto termina, sin vaciar el pool entre iteraciones
+    def __init__(self, pool: ProductRenderPool, max_in_flight: int, render_cache: RenderCache = None) -> None:
+        self.__pool = pool
+        self.__render_cache = render_cache
+        self.__slots = threading.BoundedSemaphore(max_in_flight)
+        self.__condition = threading.Condition()
+        self.__in_flight = 0
+        self.__errors = []
+
+    @property
+    def in_flight(self) -> int:
+        return self.__in_flight
+
+    def submit(self, method: str, callback = None, **options) -> Future:
+        # Con cache de renderizado, un producto sin cambios se omite y regresa None; a la respuesta de los
+        # demas se agrega su "render_key" para confirmarlo en el cache cuando se registre
+        key = None
+        if self.__render_cache is not None:
+            key = self.__render_cache.key(method, options)
+            if self.__render_cache.lookup(key):
+                return None
+        # Bloquea mientras haya max_in_flight productos sin terminar
+        self.__slots.acquire()
+        with self.__condition:
+            self.__in_flight += 1
+        try:
+            future = self.__pool.submit(method, **options)
+        except BaseException:
+            self.__release()
+            raise
+        future.add_done_callback(lambda done: self.__complete(done, callback, key))
+        return future
+
+    def __complete(self, future: Future, callback, key: str) -> None:
+        # Se ejecuta en el hilo que recibe los resultados del pool
+        try:
+            response = future.result()
+            if key is not None:
+                self.__render_cache.record(key, response)
+                response = {**response, "render_key": key}
+            if callback is not None:
+                callback(response)
+        except Exception as e:
+            with self.__condition:
+                self.__errors.append(e)
+        finally:
+            self.__release()
+
+    def __release(self) -> None:
+        with self.__condition:
+            self.__in_flight -= 1
+            self.__slots.release()
+            self.__condition.notify_all()
+
+    def wait(self) -> None:
+        # Espera a que no quede trabajo en vuelo y propaga el primer error de renderizado o de callback
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__in_flight == 0)
+            errors, self.__errors = self.__errors, []
+        if errors:
+            raise errors[0]
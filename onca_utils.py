@@ -1,13 +1,62 @@
 import pandas as pd
+import numpy as np
 import os
+import json
+import hashlib
+import re
+import gzip
+from collections import OrderedDict
+from plotly.offline import get_plotlyjs, get_plotlyjs_version
 import unicodedata
+import threading
+import queue
+import requests
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from client import Product,Level
 
+# Columnas de los archivos crudos de defunciones que se utilizan
+DEATHS_COLUMNS = ['ANIO_OCUR', 'ENT_OCURR', 'MUN_OCURR', 'CAUSA_DEF', 'SEXO' ,'EDAD']
+# Manifiesto del almacen Parquet (archivo fuente -> tamaño, fecha y sha256); pyarrow ignora los archivos que empiezan con "_"
+DEATHS_STORE_MANIFEST = "_manifest.json"
+# Tipos compactos para la lectura por bloques; los encabezados llegan en mayusculas o minusculas. Se leen como
+# enteros nulables porque un archivo crudo puede traer campos vacios
+DEATHS_DTYPES = {column: dtype for name, dtype in {
+    'ANIO_OCUR': 'Int16', 'ENT_OCURR': 'Int8', 'MUN_OCURR': 'Int16',
+    'CAUSA_DEF': 'str', 'SEXO': 'Int8', 'EDAD': 'Int16'}.items()
+    for column in (name, name.lower())}
+# Claves de "no especificado" de INEGI con que se reemplazan los campos vacios de los archivos crudos (EDAD vacia
+# queda fuera al cruzar con el catalogo de edades, igual que en la lectura completa)
+DEATHS_UNSPECIFIED = {'ANIO_REGIS': 9999, 'ENT_OCURR': 99, 'MUN_OCURR': 999, 'SEXO': 9}
+
+# Grupos quinquenales de edad de CONAPO, en orden
+AGE_GROUPS = ['00_04', '05_09', '10_14', '15_19', '20_24', '25_29', '30_34', '35_39', '40_44',
+              '45_49', '50_54', '55_59', '60_64', '65_69', '70_74', '75_79', '80_84', '>85']
+AGE_GROUP_DTYPE = pd.CategoricalDtype(AGE_GROUPS, ordered=True)
+# Representacion compacta de las dimensiones compartidas por defunciones y poblaciones
+DIMENSION_DTYPES = {'ANIO_REGIS': 'int16', 'ENT_CVE': 'int8', 'MUN_CVE': 'int16',
+                    'SEXO': 'int8', 'RANGO_EDAD': AGE_GROUP_DTYPE}
+# Claves de "no especificado" de INEGI para las dimensiones enteras que lleguen vacias
+DIMENSION_UNSPECIFIED = {'ANIO_REGIS': 9999, 'ENT_CVE': 99, 'MUN_CVE': 999, 'SEXO': 9}
+RATE_SCALES = {'TASA_CRUDA_1K': 1000, 'TASA_CRUDA_10K': 10000, 'TASA_CRUDA_100K': 100000}
+
+def compact_dimensions(df: pd.DataFrame) -> pd.DataFrame:
+    if 'RANGO_EDAD' in df.columns and not isinstance(df.RANGO_EDAD.dtype, pd.CategoricalDtype):
+        # Los rangos de edad fuera del catalogo (p. ej. edad no especificada) quedan como NaN
+        df = df.assign(RANGO_EDAD=df.RANGO_EDAD.where(df.RANGO_EDAD.isin(AGE_GROUPS)))
+    # Un valor vacio no cabe en un entero; se recodifica como no especificado en lugar de descartar el registro
+    unspecified = {column: code for column, code in DIMENSION_UNSPECIFIED.items() if column in df.columns and df[column].hasnans}
+    if unspecified:
+        df = df.fillna(unspecified)
+    return df.astype({column: dtype for column, dtype in DIMENSION_DTYPES.items() if column in df.columns})
+
 class MortalityStandardizer:
     def __init__(self, file_path:str, std_name:str, age_groups:list) -> None:
         self.__std_pop = pd.read_csv(file_path)
         self.__age_groups = age_groups
         self.__std_pop["W"] = self.__std_pop["W"]/100
+        # Pesos de todos los grupos de edad en el orden de AGE_GROUPS, para el calculo por lotes
+        self.__weights = self.__std_pop.set_index("Age")["W"].reindex(AGE_GROUPS).to_numpy()
         
         if self.__std_pop["Age"].shape[0] != len(age_groups):
             self.__std_pop = self.__std_pop[self.__std_pop["Age"].isin(age_groups)].copy()
@@ -25,45 +74,437 @@ class MortalityStandardizer:
         
     def compute_ASR(self, df:pd.DataFrame, age_column:str, rate_column:str, scale:str) -> pd.DataFrame:
         df = df.merge(self.__std_pop, left_on=age_column, right_on="Age").drop(columns=["Age"])
-        asr_name = f"ASR({self.__std_name})_" + scale
+        asr_name = self.asr_name(scale)
         df[asr_name] = df[rate_column] * df["W"]
         df = df.drop(columns=[age_column, rate_column,"W"])
         group_columns = df.columns.drop(asr_name).to_list()
         df = df.groupby(group_columns).agg({asr_name:"sum"}).reset_index()
         return df
 
+    def asr_name(self, scale:str) -> str:
+        return f"ASR({self.__std_name})_" + scale
+
+    def range_weights(self, ranges:list) -> np.ndarray:
+        # Matriz (rangos x grupos de edad) con los pesos de cada rango renormalizados a ese rango,
+        # igual que al construir un MortalityStandardizer con AGE_GROUPS[start:end]
+        weights = np.zeros((len(ranges), len(AGE_GROUPS)))
+        for row, (start, end) in enumerate(ranges):
+            weights[row, start:end] = self.__weights[start:end]
+            if end - start != len(AGE_GROUPS):
+                weights[row] /= weights[row].sum()
+        return weights
+
+    def compute_range_ASR(self, rates:np.ndarray, ranges:list) -> np.ndarray:
+        # rates: (..., grupos de edad) tasas especificas por edad; regresa (rangos, ...)
+        return np.moveaxis(rates @ self.range_weights(ranges).T, -1, 0)
+
+class PopulationCube:
+    AXES = ['ANIO_REGIS', 'ENT_CVE', 'MUN_CVE', 'SEXO', 'RANGO_EDAD']
+
+    def __init__(self, values:np.ndarray, present:np.ndarray, labels:dict) -> None:
+        # values: anio x entidad x municipio x sexo x grupo de edad
+        # present: misma forma con eje de edad de tamaño 1; indica las celdas que existen en CONAPO
+        self.__values = values
+        self.__present = present
+        self.__labels = labels
+
+    @property
+    def values(self) -> np.ndarray:
+        return self.__values
+
+    @property
+    def labels(self) -> dict:
+        return self.__labels
+
+    @property
+    def columns(self) -> list:
+        return self.AXES + ['POBLACION_ESTRATO']
+
+    @staticmethod
+    def from_populations(populations:pd.DataFrame) -> 'PopulationCube':
+        labels = {axis: np.sort(populations[axis].dropna().unique()) for axis in PopulationCube.AXES if axis != 'RANGO_EDAD'}
+        labels['RANGO_EDAD'] = np.array(AGE_GROUPS)
+        shape = tuple(len(labels[axis]) for axis in PopulationCube.AXES)
+        index = tuple(np.searchsorted(labels[axis], populations[axis]) for axis in PopulationCube.AXES[:-1])
+        # Para la edad se usa el codigo de la categoria ordenada
+        age_index = populations.RANGO_EDAD.astype(AGE_GROUP_DTYPE).cat.codes.to_numpy()
+        flat = np.ravel_multi_index(index + (age_index,), shape)
+        values = np.bincount(flat, weights=populations.POBLACION_ESTRATO.to_numpy(), minlength=np.prod(shape))
+        values = values.round().astype('int64').reshape(shape)
+        present = np.zeros(shape[:-1] + (1,), dtype=bool)
+        present[index] = True
+        return PopulationCube(values, present, labels)
+
+    def save(self, file_path:str, source_hash:str) -> None:
+        np.save(file_path + ".npy", self.__values)
+        np.save(file_path + ".present.npy", self.__present)
+        with open(file_path + ".json", "w") as outfile:
+            outfile.write(json.dumps({"source_hash": source_hash,
+                                      "labels": {axis: labels.tolist() for axis, labels in self.__labels.items()}}))
+
+    @staticmethod
+    def load(file_path:str, source_hash:str) -> 'PopulationCube':
+        # Regresa None si no hay cubo guardado o si fue generado a partir de otro archivo fuente
+        if not os.path.exists(file_path + ".json"):
+            return None
+        with open(file_path + ".json", "r") as infile:
+            metadata = json.loads(infile.read())
+        if metadata["source_hash"] != source_hash:
+            return None
+        values = np.load(file_path + ".npy", mmap_mode="r")
+        present = np.load(file_path + ".present.npy", mmap_mode="r")
+        labels = {axis: np.array(labels) for axis, labels in metadata["labels"].items()}
+        return PopulationCube(values, present, labels)
+
+    def aggregate(self, group_columns:list) -> pd.DataFrame:
+        # Equivalente a populations.groupby(group_columns).POBLACION_ESTRATO.sum() sumando ejes del cubo
+        kept_axes = [self.AXES.index(column) for column in group_columns]
+        dropped_axes = tuple(axis for axis in range(len(self.AXES)) if axis not in kept_axes)
+        order = np.argsort(np.argsort(kept_axes))
+        values = np.transpose(self.__values.sum(axis=dropped_axes), order)
+        present = np.transpose(self.__present.any(axis=dropped_axes), order)
+        present = np.broadcast_to(present, values.shape)
+
+        index = pd.MultiIndex.from_product([self.__labels[column] for column in group_columns], names=group_columns)
+        population = pd.DataFrame({'POBLACION_ESTRATO': values.ravel()}, index=index)
+        population = population[present.ravel()].reset_index()
+        return compact_dimensions(population)
+
 class MortalityCalculator:
-    def compute_raw_mortality_rate(self, deaths:pd.DataFrame, population:pd.DataFrame, group_columns:list) -> pd.DataFrame:
-        mortality_rates = deaths.groupby(group_columns).size().reset_index(name="DEFUNCIONES")
-        population = population.groupby(group_columns) \
-            .agg({'POBLACION_ESTRATO':['sum']})['POBLACION_ESTRATO'].reset_index().rename(columns={'sum':'POBLACION_ESTRATO'})
+    def compute_raw_mortality_rate(self, deaths:pd.DataFrame, population:pd.DataFrame | PopulationCube, group_columns:list) -> pd.DataFrame:
+        mortality_rates = deaths.groupby(group_columns, observed=True).size().reset_index(name="DEFUNCIONES")
+        # Columnas como CAUSA_DEF solo existen en las defunciones; la poblacion se agrega sin ellas
+        population_columns = [column for column in group_columns if column in population.columns]
+        population = aggregate_population(population, population_columns)
         mortality_rates = mortality_rates.merge(population)
-        raw_ratio = mortality_rates.DEFUNCIONES / mortality_rates.POBLACION_ESTRATO
-        mortality_rates['TASA_CRUDA_1K'] = raw_ratio * 1000
-        mortality_rates['TASA_CRUDA_10K'] = raw_ratio * 10000
-        mortality_rates['TASA_CRUDA_100K'] = raw_ratio * 100000
+        return add_raw_rates(mortality_rates)
+
+    def compute_grouped_rates(self, deaths:pd.DataFrame, population:pd.DataFrame | PopulationCube, group_columns:list) -> dict:
+        # Tasas por sexo (1, 2) y de ambos sexos (3) a partir de una sola agregacion por sexo;
+        # los conteos y denominadores de ambos sexos son la suma de los agregados por sexo
+        group_columns = [column for column in group_columns if column != 'SEXO']
+        population_columns = [column for column in group_columns if column in population.columns]
+        deaths_by_sex = deaths.groupby(group_columns + ['SEXO'], observed=True).size().reset_index(name="DEFUNCIONES")
+        population_by_sex = aggregate_population(population, population_columns + ['SEXO'])
+
+        mortality_rates = {}
+        for sex_id in population_by_sex.SEXO.unique():
+            sex_deaths = deaths_by_sex[deaths_by_sex.SEXO == sex_id].drop(columns=['SEXO'])
+            sex_population = population_by_sex[population_by_sex.SEXO == sex_id].drop(columns=['SEXO'])
+            mortality_rates[int(sex_id)] = add_raw_rates(sex_deaths.merge(sex_population))
+
+        both_deaths = deaths_by_sex.groupby(group_columns, observed=True).DEFUNCIONES.sum().reset_index()
+        both_population = population_by_sex.groupby(population_columns, observed=True).POBLACION_ESTRATO.sum().reset_index()
+        mortality_rates[3] = add_raw_rates(both_deaths.merge(both_population))
         return mortality_rates
 
+class AgeRangeEngine:
+    def __init__(self, deaths:pd.DataFrame, population:pd.DataFrame | PopulationCube, group_columns:list) -> None:
+        # Defunciones y poblacion por grupo de edad base en arreglos densos (grupos..., edad);
+        # cualquier rango contiguo de edades se obtiene con sumas acumuladas sobre el eje de edad
+        self.__group_columns = [column for column in group_columns if column != 'RANGO_EDAD']
+        population_columns = [column for column in self.__group_columns if column in population.columns]
+        population = aggregate_population(population, population_columns + ['RANGO_EDAD'])
+
+        # Las etiquetas incluyen valores que solo aparecen en defunciones (p. ej. SEXO 9) para que
+        # sumar un eje conserve esas defunciones; sin poblacion presente nunca se reportan por si solas
+        self.__labels = {}
+        for column in self.__group_columns:
+            labels = np.asarray(deaths[column].dropna().unique())
+            if column in population_columns:
+                labels = np.union1d(labels, np.asarray(population[column].dropna().unique()))
+            self.__labels[column] = np.sort(labels)
+        shape = tuple(len(labels) for labels in self.__labels.values()) + (len(AGE_GROUPS),)
+        population_shape = tuple(len(self.__labels[column]) if column in population_columns else 1
+                                 for column in self.__group_columns) + (len(AGE_GROUPS),)
+
+        index, valid = self.__encode(population, population_columns)
+        population_values = np.zeros(population_shape, dtype='int64')
+        present = np.zeros(population_shape, dtype=bool)
+        population_values[index] = population.POBLACION_ESTRATO.to_numpy()[valid]
+        present[index] = True
+
+        index, valid = self.__encode(deaths, self.__group_columns)
+        flat = np.ravel_multi_index(index, shape)
+        deaths_values = np.bincount(flat, minlength=np.prod(shape)).reshape(shape)
+        self.__set_arrays(deaths_values, population_values, present)
+
+    def __set_arrays(self, deaths:np.ndarray, population:np.ndarray, present:np.ndarray) -> None:
+        self.__deaths = deaths
+        self.__population = population
+        self.__present = present
+        self.__cumulative_deaths = self.__cumulative(self.__deaths)
+        self.__cumulative_population = self.__cumulative(self.__population)
+        self.__cumulative_present = self.__cumulative(self.__present.astype('int64'))
+
+    def both_sexes(self) -> 'AgeRangeEngine':
+        # Motor de ambos sexos obtenido sumando el eje SEXO de los arreglos, sin volver a agrupar
+        axis = self.__group_columns.index('SEXO')
+        engine = AgeRangeEngine.__new__(AgeRangeEngine)
+        engine.__group_columns = [column for column in self.__group_columns if column != 'SEXO']
+        engine.__labels = {column: labels for column, labels in self.__labels.items() if column != 'SEXO'}
+        engine.__set_arrays(self.__deaths.sum(axis=axis),
+                            self.__population.sum(axis=axis),
+                            self.__present.any(axis=axis))
+        return engine
+
+    @property
+    def group_columns(self) -> list:
+        return self.__group_columns
+
+    @property
+    def ranges(self) -> list:
+        # Mismo orden que los ciclos de onca_v2: primero por longitud y luego por inicio
+        return [(start, start + length) for length in range(1, len(AGE_GROUPS) + 1)
+                for start in range(len(AGE_GROUPS) - length + 1)]
+
+    def age_specific_rates(self, start:int, end:int) -> pd.DataFrame:
+        # Equivalente a compute_raw_mortality_rate(deaths[RANGO_EDAD en AGE_GROUPS[start:end]], population,
+        # group_columns + ['RANGO_EDAD'])
+        deaths = self.__deaths[..., start:end]
+        population = np.broadcast_to(self.__population[..., start:end], deaths.shape)
+        present = np.broadcast_to(self.__present[..., start:end], deaths.shape)
+        index = np.nonzero((deaths > 0) & present)
+
+        mortality_rates = self.__decode(index[:-1])
+        mortality_rates['RANGO_EDAD'] = pd.Categorical.from_codes(index[-1] + start, dtype=AGE_GROUP_DTYPE)
+        mortality_rates['DEFUNCIONES'] = deaths[index]
+        mortality_rates['POBLACION_ESTRATO'] = population[index]
+        return add_raw_rates(mortality_rates)
+
+    def range_counts(self) -> tuple:
+        # Defunciones, poblacion y presencia de cada rango de self.ranges: arreglos (rangos, grupos...)
+        starts, ends = np.array(self.ranges).T
+        deaths = self.__cumulative_deaths[..., ends] - self.__cumulative_deaths[..., starts]
+        population = self.__cumulative_population[..., ends] - self.__cumulative_population[..., starts]
+        present = (self.__cumulative_present[..., ends] - self.__cumulative_present[..., starts]) > 0
+        deaths, population, present = (np.moveaxis(array, -1, 0) for array in (deaths, population, present))
+        return deaths, np.broadcast_to(population, deaths.shape), np.broadcast_to(present, deaths.shape)
+
+    def age_specific_rate_array(self, rate_column:str="TASA_CRUDA_100K") -> tuple:
+        # Tasas especificas por edad (grupos..., edad) y las celdas que compute_raw_mortality_rate reportaria
+        observed = (self.__deaths > 0) & self.__present
+        population = np.broadcast_to(self.__population, self.__deaths.shape)
+        rates = np.divide(self.__deaths * RATE_SCALES[rate_column], population,
+                          out=np.zeros(self.__deaths.shape), where=observed)
+        return rates, observed
+
+    def range_ASR(self, standardizer:MortalityStandardizer, rate_column:str="TASA_CRUDA_100K", scale:str="100K") -> pd.DataFrame:
+        # Tasas estandarizadas de todos los rangos de edad con una sola multiplicacion de matrices
+        rates, observed = self.age_specific_rate_array(rate_column)
+        asr = standardizer.compute_range_ASR(rates, self.ranges)
+        observed = self.__cumulative(observed.astype('int64'))
+        starts, ends = np.array(self.ranges).T
+        observed = np.moveaxis(observed[..., ends] - observed[..., starts], -1, 0) > 0
+        index = np.nonzero(observed)
+
+        labels = np.array([age_range_label(AGE_GROUPS[start:end]) for start, end in self.ranges])
+        asr_rates = pd.DataFrame({'EDADES': labels[index[0]]})
+        asr_rates = pd.concat([asr_rates, self.__decode(index[1:])], axis=1)
+        asr_rates[standardizer.asr_name(scale)] = asr[index]
+        return asr_rates
+
+    def range_rates(self, drop_empty:bool=True) -> pd.DataFrame:
+        # Tasas crudas de cada rango completo de edades para todos los rangos a la vez
+        deaths, population, present = self.range_counts()
+        mask = present & (deaths > 0) if drop_empty else present
+        index = np.nonzero(mask)
+
+        labels = np.array([age_range_label(AGE_GROUPS[start:end]) for start, end in self.ranges])
+        mortality_rates = pd.DataFrame({'EDADES': labels[index[0]]})
+        mortality_rates = pd.concat([mortality_rates, self.__decode(index[1:])], axis=1)
+        mortality_rates['DEFUNCIONES'] = deaths[index]
+        mortality_rates['POBLACION_ESTRATO'] = population[index]
+        return add_raw_rates(mortality_rates)
+
+    def __encode(self, df:pd.DataFrame, columns:list) -> tuple:
+        # Indices de cada registro en los ejes densos; descarta valores fuera de las etiquetas
+        age_codes = pd.Index(AGE_GROUPS).get_indexer(np.asarray(df.RANGO_EDAD, dtype=object))
+        valid = age_codes >= 0
+        codes = []
+        for column in columns:
+            labels = self.__labels[column]
+            values = df[column].to_numpy()
+            code = np.searchsorted(labels, values).clip(0, len(labels) - 1)
+            valid &= labels[code] == values
+            codes.append(code)
+        index = tuple(code[valid] for code in codes) + (age_codes[valid],)
+        if len(columns) < len(self.__group_columns):
+            # Ejes ausentes (p. ej. CAUSA_DEF en poblacion) se indexan con 0 sobre un eje de tamaño 1
+            by_column = dict(zip(columns, index))
+            index = tuple(by_column.get(column, np.zeros(valid.sum(), dtype='int64'))
+                          for column in self.__group_columns) + (index[-1],)
+        return index, valid
+
+    def __decode(self, index:tuple) -> pd.DataFrame:
+        return pd.DataFrame({column: self.__labels[column][codes] for column, codes in zip(self.__group_columns, index)})
+
+    @staticmethod
+    def __cumulative(values:np.ndarray) -> np.ndarray:
+        zeros = np.zeros(values.shape[:-1] + (1,), dtype=values.dtype)
+        return np.concatenate([zeros, np.cumsum(values, axis=-1)], axis=-1)
+
+class MortalityRateCache:
+    def __init__(self, calculator:MortalityCalculator, population:pd.DataFrame | PopulationCube, max_bytes:int=512 * 1024**2) -> None:
+        # Cache LRU de tasas por (causa, rango de edades, columnas de agrupacion) acotado en memoria
+        self.__calculator = calculator
+        self.__population = population
+        self.__max_bytes = max_bytes
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+        self.__engines = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def size_bytes(self) -> int:
+        return self.__bytes
+
+    def register_engine(self, cie10:str, engine:'AgeRangeEngine') -> None:
+        # Los fallos para esta causa y agrupacion se calculan rebanando el motor en lugar de agrupar
+        self.__engines[(cie10, tuple(engine.group_columns))] = engine
+
+    def compute_raw_mortality_rate(self, cie10:str, deaths:pd.DataFrame, age_groups_range:list, group_columns:list) -> pd.DataFrame:
+        key = (cie10, tuple(age_groups_range), tuple(group_columns))
+        if key in self.__entries:
+            self.hits += 1
+            self.__entries.move_to_end(key)
+            return self.__entries[key][0].copy()
+
+        self.misses += 1
+        engine = self.__engines.get((cie10, tuple(column for column in group_columns if column != 'RANGO_EDAD')))
+        if engine is not None and group_columns[-1] == 'RANGO_EDAD':
+            start = AGE_GROUPS.index(age_groups_range[0])
+            mortality_rates = engine.age_specific_rates(start, start + len(age_groups_range))
+        else:
+            mortality_rates = self.__calculator.compute_raw_mortality_rate(
+                deaths[deaths.RANGO_EDAD.isin(age_groups_range)], self.__population, group_columns)
+
+        size = int(mortality_rates.memory_usage(deep=True).sum())
+        if size <= self.__max_bytes:
+            self.__entries[key] = (mortality_rates, size)
+            self.__bytes += size
+            while self.__bytes > self.__max_bytes:
+                _, (_, evicted_size) = self.__entries.popitem(last=False)
+                self.__bytes -= evicted_size
+        return mortality_rates.copy()
+
+    def clear(self) -> None:
+        self.__entries.clear()
+        self.__bytes = 0
+
+def aggregate_population(population:pd.DataFrame | PopulationCube, group_columns:list) -> pd.DataFrame:
+    if isinstance(population, PopulationCube):
+        return population.aggregate(group_columns)
+    return population.groupby(group_columns, observed=True) \
+        .agg({'POBLACION_ESTRATO':['sum']})['POBLACION_ESTRATO'].reset_index().rename(columns={'sum':'POBLACION_ESTRATO'})
+
+def add_raw_rates(mortality_rates:pd.DataFrame) -> pd.DataFrame:
+    raw_ratio = mortality_rates.DEFUNCIONES / mortality_rates.POBLACION_ESTRATO
+    for rate_column, rate_scale in RATE_SCALES.items():
+        mortality_rates[rate_column] = raw_ratio * rate_scale
+    return mortality_rates
+
+def age_range_label(age_groups_range:list) -> str:
+    init_age = age_groups_range[0].split('_')[0]
+    end_age = age_groups_range[-1].split('_')[-1]
+
+    if init_age == '>85' and end_age == '>85':
+        return 'mas85'
+    elif end_age == '>85':
+        return f"{init_age}-mas85"
+    return f"{init_age}-{end_age}"
+
+def complete_grid(df:pd.DataFrame, axes:list, fill_value=0) -> pd.DataFrame:
+    # Malla completa (producto de los valores observados de cada eje) en un solo reindex. Cada eje es una lista de
+    # columnas que viajan juntas, p. ej. ['ENT_CVE','ENT_NOMBRE']; el resultado queda ordenado por los ejes en el orden dado
+    keys = [column for axis in axes for column in axis]
+    levels = [df[axis].drop_duplicates().sort_values(axis, ignore_index=True) for axis in axes]
+    codes = np.indices([len(level) for level in levels]).reshape(len(levels), -1)
+    grid = pd.concat([level.iloc[code].reset_index(drop=True) for level, code in zip(levels, codes)], axis=1)
+    return df.set_index(keys).reindex(pd.MultiIndex.from_frame(grid), fill_value=fill_value).reset_index()[df.columns]
+
+class PartitionedFrame:
+    # Particiona un DataFrame una sola vez por una llave de reparto (p. ej. ANIO_REGIS): un ordenamiento estable y los
+    # limites de cada bloque. Cada particion es una vista contigua (iloc) sin copia; al enviarse a otro proceso
+    # solo se serializan las filas de la particion
+    def __init__(self, df:pd.DataFrame, key:str | list, order_by:list = [], presorted:bool = False) -> None:
+        keys = [key] if isinstance(key, str) else list(key)
+        if not presorted:
+            df = df.sort_values(keys + list(order_by), kind='stable', ignore_index=True)
+        changes = np.zeros(max(len(df) - 1, 0), dtype=bool)
+        for column in keys:
+            values = df[column].to_numpy()
+            changes |= values[1:] != values[:-1]
+        bounds = np.flatnonzero(changes) + 1
+        self.__frame = df
+        self.__starts = np.r_[0, bounds] if len(df) else bounds
+        self.__stops = np.r_[bounds, len(df)] if len(df) else bounds
+        key_rows = df[keys].iloc[self.__starts].itertuples(index=False)
+        self.__values = [row[0] if len(keys) == 1 else tuple(row) for row in key_rows]
+        self.__positions = {value: position for position, value in enumerate(self.__values)}
+
+    @property
+    def frame(self) -> pd.DataFrame:
+        return self.__frame
+
+    def keys(self) -> list:
+        return list(self.__values)
+
+    def __len__(self) -> int:
+        return len(self.__values)
+
+    def __contains__(self, value) -> bool:
+        return value in self.__positions
+
+    def __getitem__(self, value) -> pd.DataFrame:
+        position = self.__positions[value]
+        return self.__frame.iloc[self.__starts[position]:self.__stops[position]]
+
+    def __iter__(self):
+        for value, start, stop in zip(self.__values, self.__starts, self.__stops):
+            yield value, self.__frame.iloc[start:stop]
+
 class CatalogLoader:
-    def load_conapo_populations(self, file_path:str) -> pd.DataFrame:
+    def load_conapo_populations(self, file_path:str, compact:bool=False) -> pd.DataFrame:
         pe = pd.read_csv(file_path).drop_duplicates()
-        pe = pe.melt(['ANIO_REGIS', 'cve_ent_mun', 'ENT_OCURR', 'MUN_OCURR', 'SEXO'], ['00_04', '05_09',
-        '10_14', '15_19', '20_24', '25_29', '30_34', '35_39', '40_44', '45_49',
-        '50_54', '55_59', '60_64', '65_69', '70_74', '75_79', '80_84', '>85'], var_name="RANGO_EDAD", value_name="POBLACION_ESTRATO")
         pe = pe[pe.SEXO!='Total']
-        pe = pe.sort_values(['ANIO_REGIS', 'ENT_OCURR', 'MUN_OCURR', 'RANGO_EDAD', 'SEXO']).reset_index(drop=True).drop(columns=['cve_ent_mun'])
+        # Solo se recodifica la columna SEXO en lugar de reemplazar sobre todo el DataFrame
+        pe['SEXO'] = pe.SEXO.map({'Hombres':1,'Mujeres':2})
         pe = pe.rename(columns={'ENT_OCURR':'ENT_CVE', 'MUN_OCURR':'MUN_CVE'})
-        pe = pe.replace({'Hombres':1,'Mujeres':2})    
+        if compact:
+            # Se compacta antes de melt para que las columnas repetidas 18 veces ya sean pequeñas
+            pe = compact_dimensions(pe)
+        pe = pe.melt(['ANIO_REGIS', 'cve_ent_mun', 'ENT_CVE', 'MUN_CVE', 'SEXO'], AGE_GROUPS,
+                     var_name="RANGO_EDAD", value_name="POBLACION_ESTRATO")
+        if compact:
+            pe['RANGO_EDAD'] = pe.RANGO_EDAD.astype(AGE_GROUP_DTYPE)
+        pe = pe.sort_values(['ANIO_REGIS', 'ENT_CVE', 'MUN_CVE', 'RANGO_EDAD', 'SEXO']).reset_index(drop=True).drop(columns=['cve_ent_mun'])
         return pe
     
+    def load_population_cube(self, file_path:str) -> PopulationCube:
+        # El cubo se guarda junto al CSV y se reutiliza mientras el hash del CSV no cambie
+        cube_path = os.path.splitext(file_path)[0] + "_cube"
+        source_hash = file_sha256(file_path)
+        cube = PopulationCube.load(cube_path, source_hash)
+        if cube is None:
+            print(f"Generando cubo de poblaciones en {cube_path}")
+            cube = PopulationCube.from_populations(self.load_conapo_populations(file_path, compact=True))
+            cube.save(cube_path, source_hash)
+            cube = PopulationCube.load(cube_path, source_hash)
+        return cube
+
     def load_oms_populations(self, file_path:str) -> pd.DataFrame:
         return pd.read_csv(file_path)
     
     def load_inegi_populations(self, file_path:str) -> pd.DataFrame:
         return pd.read_csv(file_path)
     
-    def load_states(self, file_path:str) -> pd.DataFrame:
+    def load_states(self, file_path:str, compact:bool=False) -> pd.DataFrame:
         cat_entidades = pd.read_csv(file_path).rename(columns={'ENT_OCURR':'ENT_CVE','ENT_NAME':'ENT_NOMBRE'})
+        if compact:
+            # Llave entera del mismo tipo que ENT_CVE en defunciones y poblaciones
+            cat_entidades = compact_dimensions(cat_entidades)
         return cat_entidades
     
     def load_municipalities(self, file_path:str) -> pd.DataFrame:
@@ -78,38 +519,257 @@ class CatalogLoader:
         return pd.read_csv(file_path)
     
 class DeathRegistryLoader:
-    def load_deaths(self, input_mortality_folder:str, cat_edades:pd.DataFrame, cie10:str):
+    def load_deaths(self, input_mortality_folder:str, cat_edades:pd.DataFrame, cie10:str | list, workers:int=1,
+                    chunksize:int=None, min_year:int=None, compact:bool=False):
         print(f"Realizando extracción de registros para {cie10}")
         files_names = os.listdir(input_mortality_folder)
         files_names.sort()
-        deaths = pd.DataFrame()
+        files_paths = [input_mortality_folder + file_name for file_name in files_names]
 
+        if workers > 1 and len(files_paths) > 1:
+            # Cada archivo se preprocesa en un proceso independiente
+            with ProcessPoolExecutor(max_workers=min(workers, len(files_paths))) as executor:
+                frames = list(executor.map(DeathRegistryLoader._load_deaths_file, files_paths,
+                                           repeat(cat_edades), repeat(cie10), repeat(chunksize), repeat(min_year),
+                                           repeat(compact)))
+        else:
+            frames = [self._load_deaths_file(file_path, cat_edades, cie10, chunksize, min_year, compact)
+                      for file_path in files_paths]
+
+        if len(frames) == 0:
+            return pd.DataFrame()
+        # Una sola concatenacion al final en lugar de una por archivo
+        return pd.concat(frames, ignore_index=True)
+
+    @staticmethod
+    def _load_deaths_file(input_path: str, cat_edades: pd.DataFrame, cie10: str | list,
+                          chunksize: int = None, min_year: int = None, compact: bool = False) -> pd.DataFrame:
+        # Metodo estatico para poder enviarlo a los procesos del pool
+        print("Procesando archivo {}".format(os.path.basename(input_path)))
+        if chunksize is not None:
+            deaths = DeathRegistryLoader().__stream_deaths_data(input_path, cat_edades, cie10, chunksize, min_year)
+        else:
+            deaths = DeathRegistryLoader().__preprocess_deaths_data(input_path, cat_edades, cie10)
+            if min_year is not None:
+                deaths = deaths[deaths.ANIO_REGIS >= min_year]
+        return compact_dimensions(deaths) if compact else deaths
+    
+    def build_deaths_store(self, input_mortality_folder:str, output_store_folder:str, prefix_length:int=1, workers:int=1) -> None:
+        # Actualizacion incremental: el manifiesto guarda tamaño, fecha de modificacion y sha256 de cada archivo fuente
+        # y solo se convierten los archivos nuevos o modificados; las partes de archivos que ya no estan se eliminan
+        manifest_path = os.path.join(output_store_folder, DEATHS_STORE_MANIFEST)
+        manifest = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as infile:
+                manifest = json.loads(infile.read())
+        if manifest.get("prefix_length", prefix_length) != prefix_length:
+            manifest = {}
+        sources = manifest.get("sources", {})
+
+        files_names = os.listdir(input_mortality_folder)
+        files_names.sort()
+        entries, changed, touched = {}, [], False
         for file_name in files_names:
-            print("Procesando archivo {}".format(file_name))
-            raw_data = self.__preprocess_deaths_data(input_mortality_folder + file_name, cat_edades, cie10)            
-            deaths = pd.concat([deaths,raw_data], ignore_index=True)
-        return deaths
+            stat = os.stat(input_mortality_folder + file_name)
+            entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+            previous = sources.get(file_name)
+            if previous is not None and all(previous.get(field) == value for field, value in entry.items()):
+                continue
+            # Solo se calcula el sha256 de los archivos cuyo tamaño o fecha de modificacion cambiaron
+            entry["sha256"] = file_sha256(input_mortality_folder + file_name)
+            entries[file_name] = entry
+            if previous is not None and previous.get("sha256") == entry["sha256"]:
+                sources[file_name] = entry
+                touched = True
+            else:
+                changed.append(file_name)
+        removed = [file_name for file_name in sources if file_name not in files_names]
+        if len(changed) == 0 and len(removed) == 0:
+            if touched:
+                self.__save_store_manifest(manifest_path, prefix_length, sources)
+            return
+        print(f"Actualizando almacen columnar de registros de mortalidad en {output_store_folder}: "
+              f"{len(changed)} archivos nuevos o modificados, {len(removed)} eliminados")
+
+        os.makedirs(output_store_folder, exist_ok=True)
+        for file_name in changed + removed:
+            # Si el archivo ya no cubre algun anio o prefijo, sus partes anteriores no deben quedar en el almacen
+            self.__remove_store_parts(output_store_folder, file_name)
+            sources.pop(file_name, None)
+        self.__save_store_manifest(manifest_path, prefix_length, sources)
+
+        files_paths = [input_mortality_folder + file_name for file_name in changed]
+        if workers > 1 and len(files_paths) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(files_paths))) as executor:
+                converted = executor.map(DeathRegistryLoader._store_deaths_file, files_paths,
+                                         repeat(output_store_folder), repeat(prefix_length))
+                for file_name, _ in zip(changed, converted):
+                    sources[file_name] = entries[file_name]
+                    self.__save_store_manifest(manifest_path, prefix_length, sources)
+        else:
+            for file_name, file_path in zip(changed, files_paths):
+                self._store_deaths_file(file_path, output_store_folder, prefix_length)
+                sources[file_name] = entries[file_name]
+                self.__save_store_manifest(manifest_path, prefix_length, sources)
+
+    @staticmethod
+    def __remove_store_parts(output_store_folder:str, file_name:str) -> None:
+        # Solo las partes <nombre>-<i>.parquet de este archivo; un prefijo comun (defun19 y defun19-2) no basta
+        part_pattern = re.compile(r"^{}-\d+\.parquet$".format(re.escape(os.path.splitext(file_name)[0])))
+        for folder, _, parts in os.walk(output_store_folder):
+            for part in parts:
+                if part_pattern.match(part):
+                    os.remove(os.path.join(folder, part))
+
+    @staticmethod
+    def __save_store_manifest(manifest_path:str, prefix_length:int, sources:dict) -> None:
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w") as outfile:
+            outfile.write(json.dumps({"prefix_length": prefix_length, "sources": sources}))
+        os.replace(tmp_path, manifest_path)
+
+    @staticmethod
+    def _store_deaths_file(input_path: str, output_store_folder: str, prefix_length: int) -> None:
+        print("Convirtiendo archivo {}".format(os.path.basename(input_path)))
+        deaths = pd.read_csv(input_path, usecols=lambda column: column.upper() in DEATHS_COLUMNS)
+        deaths = deaths.rename(columns=str.upper)[DEATHS_COLUMNS]
+        deaths = deaths.rename(columns={'ANIO_OCUR':'ANIO_REGIS'})
+        deaths['CAUSA_PREFIJO'] = deaths.CAUSA_DEF.str[:prefix_length]
+        # Particiones ANIO_REGIS=<anio>/CAUSA_PREFIJO=<prefijo>; el nombre del archivo fuente
+        # hace que volver a convertir un archivo sobrescriba sus propias partes
+        file_stem = os.path.splitext(os.path.basename(input_path))[0]
+        deaths.to_parquet(output_store_folder,
+                          partition_cols=['ANIO_REGIS', 'CAUSA_PREFIJO'],
+                          index=False,
+                          basename_template=file_stem + "-{i}.parquet",
+                          existing_data_behavior="overwrite_or_ignore")
+
+    def load_deaths_from_store(self, input_store_folder:str, cat_edades:pd.DataFrame, cie10:str | list,
+                               prefix_length:int=1, min_year:int=2000, compact:bool=False) -> pd.DataFrame:
+        print(f"Realizando extracción de registros para {cie10} desde {input_store_folder}")
+        # Solo se leen las particiones del anio y prefijo CIE10 solicitados
+        filters = [('ANIO_REGIS', '>=', min_year)]
+        codes = [cie10] if isinstance(cie10, str) else list(cie10)
+        if all(len(code) >= prefix_length for code in codes):
+            filters.append(('CAUSA_PREFIJO', 'in', sorted({code[:prefix_length] for code in codes})))
+        deaths = pd.read_parquet(input_store_folder, filters=filters)
+        deaths = deaths.drop(columns=['CAUSA_PREFIJO'])
+        deaths['ANIO_REGIS'] = deaths.ANIO_REGIS.astype('int64')
+        deaths = deaths[['ANIO_REGIS', 'ENT_OCURR', 'MUN_OCURR', 'CAUSA_DEF', 'SEXO' ,'EDAD']]
+        deaths = self.__select_cause(deaths, cat_edades, cie10)
+        return compact_dimensions(deaths) if compact else deaths
     
-    def __preprocess_deaths_data(self, input_path: str, cat_edades: pd.DataFrame, cie10: str) -> pd.DataFrame:
+    def __preprocess_deaths_data(self, input_path: str, cat_edades: pd.DataFrame, cie10: str | list) -> pd.DataFrame:
         deaths = pd.read_csv(input_path)
         deaths = deaths.rename(columns=str.upper)
-        deaths = deaths[['ANIO_OCUR', 'ENT_OCURR', 'MUN_OCURR', 'CAUSA_DEF', 'SEXO' ,'EDAD']]
+        deaths = deaths[DEATHS_COLUMNS]
         deaths = deaths.rename(columns={'ANIO_OCUR':'ANIO_REGIS'})
-        deaths['CAUSA_DEF'] = deaths.CAUSA_DEF.str[:len(cie10)] # Reasignacion de etiquetas CIE10
-        deaths = deaths[deaths.CAUSA_DEF==cie10] # Seleccionamos solo la causa de defuncion especifica
+        return self.__select_cause(deaths, cat_edades, cie10)
+
+    def __stream_deaths_data(self, input_path: str, cat_edades: pd.DataFrame, cie10: str | list,
+                             chunksize: int, min_year: int = None) -> pd.DataFrame:
+        # Solo se leen las columnas necesarias con tipos compactos y los filtros se aplican
+        # por bloque, de modo que la memoria queda acotada por chunksize y no por el archivo
+        selected = []
+        reader = pd.read_csv(input_path,
+                             usecols=lambda column: column.upper() in DEATHS_COLUMNS,
+                             dtype=DEATHS_DTYPES,
+                             chunksize=chunksize)
+        with reader:
+            for chunk in reader:
+                chunk = chunk.rename(columns=str.upper)[DEATHS_COLUMNS]
+                chunk = chunk.rename(columns={'ANIO_OCUR':'ANIO_REGIS'})
+                chunk = chunk.fillna(DEATHS_UNSPECIFIED).astype({'ANIO_REGIS': 'int16', 'ENT_OCURR': 'int8',
+                                                                 'MUN_OCURR': 'int16', 'SEXO': 'int8'})
+                if min_year is not None:
+                    chunk = chunk[chunk.ANIO_REGIS >= min_year]
+                selected.append(self.__select_cause(chunk, cat_edades, cie10))
+        if len(selected) == 0:
+            return pd.DataFrame()
+        return pd.concat(selected, ignore_index=True)
+
+    def __select_cause(self, deaths: pd.DataFrame, cat_edades: pd.DataFrame, cie10: str | list) -> pd.DataFrame:
+        codes = [cie10] if isinstance(cie10, str) else list(dict.fromkeys(cie10))
+        codes_by_length = {}
+        for code in codes:
+            codes_by_length.setdefault(len(code), []).append(code)
+
+        # Una seleccion por longitud de prefijo; un registro puede coincidir con varias
+        # causas de distinta longitud (p. ej. C91 y C910) y aparece una vez por cada una
+        selected = []
+        for length, length_codes in codes_by_length.items():
+            prefixes = deaths.CAUSA_DEF.str[:length] # Reasignacion de etiquetas CIE10
+            mask = prefixes.isin(length_codes) # Seleccionamos solo las causas de defuncion especificas
+            selected.append(deaths[mask].assign(CAUSA_DEF=prefixes[mask]))
+        deaths = selected[0] if len(selected) == 1 else pd.concat(selected, ignore_index=True)
         deaths = deaths.merge(cat_edades, left_on='EDAD', right_on='CVE') \
             .drop(columns=['EDAD', 'CVE', 'DESCRIP']) \
             .rename(columns={'ENT_OCURR':'ENT_CVE', 'MUN_OCURR':'MUN_CVE'}) # Agregamos de columna de RANGO_EDAD
         return deaths
 
+def file_sha256(file_path:str, block_size:int=1 << 20) -> str:
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def upload_plotlyjs(mictlanx_client, MICTLANX_URL, BUCKET_ID) -> str:
+    # Sube una sola copia versionada de plotly.js por bucket y regresa la URL para los productos HTML;
+    # si la version ya esta en el bucket no se vuelve a subir
+    version = get_plotlyjs_version()
+    key = "plotlyjs_{}".format(version.replace(".", "_"))
+    url = "{}/{}/{}?content_type=application/javascript".format(MICTLANX_URL, BUCKET_ID, key)
+    if url_available(url):
+        return url
+    future = mictlanx_client.put_async(
+        key   = key,
+        value = get_plotlyjs().encode("utf-8"),
+        tags = {
+            "product_type":"plotlyjs",
+            "version":version,
+            "content_type":"application/javascript"
+        },
+        bucket_id=BUCKET_ID,
+        replication_factor=2
+    )
+    result = future.result()
+    # Un error de la subida no importa si la llave ya existe (p. ej. la subio otra corrida al mismo tiempo)
+    if result.is_err and not url_available(url):
+        raise Exception(f"No se pudo subir plotly.js {version}: {result.unwrap_err()}")
+    return url
+
+def url_available(url:str, timeout:float = 10) -> bool:
+    # Solo se revisa el estado de la respuesta, sin descargar el contenido
+    try:
+        with requests.get(url, stream=True, timeout=timeout) as response:
+            return response.status_code == 200
+    except requests.RequestException:
+        return False
+
+# Sufijo de archivo de cada codificacion de contenido soportada para los productos precomprimidos
+CONTENT_ENCODINGS = {"gzip": ".gz", "br": ".br"}
+
+def compress_artifact(content: bytes, content_encoding: str) -> bytes:
+    if content_encoding == "gzip":
+        # mtime fijo para que el mismo contenido produzca siempre los mismos bytes
+        return gzip.compress(content, compresslevel=9, mtime=0)
+    if content_encoding == "br":
+        import brotli # Dependencia opcional, solo necesaria para "br"
+        return brotli.compress(content)
+    raise ValueError(f"Codificacion de contenido no soportada: {content_encoding}")
+
 def read_data_bytes(file_path):
     with open(file_path, "rb") as file:
         data_bytes = file.read()
     return data_bytes
 
-def prepare_indexing(product_type, cie10, anio, ent_cve, mun_cve, sex_id, rate_type, response: dict, futures, products, MICTLANX_URL, BUCKET_ID, OBSERVATORY_ID, mictlanx_client):
-    name_metadata = f"{response["fname"]}.csv"
-    name_producct = f"{response["fname"]}.html"
+def prepare_indexing(product_type, cie10, anio, ent_cve, mun_cve, sex_id, rate_type, response: dict, futures, products, MICTLANX_URL, BUCKET_ID, OBSERVATORY_ID, mictlanx_client, content_encoding: str = None):
+    # Los artefactos que el generador ya comprimio traen su codificacion; si no, se comprimen aqui con content_encoding
+    encoded = response.get("content_encoding")
+    suffix = CONTENT_ENCODINGS[encoded] if encoded is not None else ""
+    name_metadata = f"{response["fname"]}.csv{suffix}"
+    name_producct = f"{response["fname"]}.html{suffix}"
 
     line = {
         "mcrespo_tipos_productos": product_type,
@@ -139,8 +799,13 @@ def prepare_indexing(product_type, cie10, anio, ent_cve, mun_cve, sex_id, rate_t
     
     print(f"\t{file_id}")
     
-    csv_data = read_data_bytes(line["name_metadata"])
-    product_data = read_data_bytes(line["name_producct"])
+    # Los generadores en modo in_memory entregan los artefactos en la respuesta
+    csv_data = response["csv"] if "csv" in response else read_data_bytes(line["name_metadata"])
+    product_data = response["html"] if "html" in response else read_data_bytes(line["name_producct"])
+    if encoded is None and content_encoding is not None:
+        csv_data = compress_artifact(csv_data, content_encoding)
+        product_data = compress_artifact(product_data, content_encoding)
+        encoded = content_encoding
     
     profile = "{}_{}_{}_{}_{}_{}_{}".format(
         line["mcrespo_tipos_productos"], 
@@ -164,6 +829,11 @@ def prepare_indexing(product_type, cie10, anio, ent_cve, mun_cve, sex_id, rate_t
     file_id = file_id.lower()
     url              = "{}/{}/product_{}".format(MICTLANX_URL,BUCKET_ID,file_id)
     url_data              = "{}/{}/csv_{}?content_type=text/csv".format(MICTLANX_URL,BUCKET_ID,file_id)
+    encoding_tags = {}
+    if encoded is not None:
+        url += "?content_encoding={}".format(encoded)
+        url_data += "&content_encoding={}".format(encoded)
+        encoding_tags = {"content_encoding": encoded}
     
     print("\t"+url)
     print("\t"+url_data)
@@ -248,7 +918,8 @@ def prepare_indexing(product_type, cie10, anio, ent_cve, mun_cve, sex_id, rate_t
             "product_type":product_type,
             "product_name":product_name,
             "profile":profile,
-            "content_type":my_type
+            "content_type":my_type,
+            **encoding_tags
         },
 
         bucket_id=BUCKET_ID,
@@ -332,7 +1003,8 @@ def prepare_indexing(product_type, cie10, anio, ent_cve, mun_cve, sex_id, rate_t
             "product_type":product_type,
             "product_name":product_name,
             "profile":profile,
-            "content_type":my_type
+            "content_type":my_type,
+            **encoding_tags
         },
 
         bucket_id=BUCKET_ID,
@@ -342,4 +1014,175 @@ def prepare_indexing(product_type, cie10, anio, ent_cve, mun_cve, sex_id, rate_t
     futures.append(future)
     print(url)
     print(url_data)
-    # print("\tLineplot") 
\ No newline at end of file
+    # print("\tLineplot") 
+
+# Marca en la cola de registro para enviar el lote incompleto
+_FLUSH_REGISTRATIONS = object()
+
+class IndexingPipeline:
+    # Subida a MictlanX y registro en el OCA en flujo continuo con limites de trabajo en vuelo: submit solo encola
+    # el producto (bloquea si hay max_queued esperando), un hilo de subida mantiene a lo sumo max_uploads productos
+    # subiendose, y otro hilo registra los productos subidos por lotes de batch_size con una cola acotada, de modo
+    # que la memoria no crece con el numero de productos. Cada lote se registra en bloques de chunk_size productos
+    # en paralelo; solo se reintentan los bloques que fallan
+    def __init__(self, mictlanx_client, oca_client, MICTLANX_URL, BUCKET_ID, OBSERVATORY_ID, max_uploads:int = 64,
+                 max_queued:int = 64, batch_size:int = 100, max_pending_batches:int = 4, chunk_size:int = 50,
+                 max_attempts:int = 3, content_encoding:str = None, on_registered = None, on_failed = None) -> None:
+        self.__mictlanx_client = mictlanx_client
+        self.__oca_client = oca_client
+        self.__mictlanx_url = MICTLANX_URL
+        self.__bucket_id = BUCKET_ID
+        self.__observatory_id = OBSERVATORY_ID
+        self.__content_encoding = content_encoding
+        # Se llaman con la respuesta del generador de cada producto registrado o que no se pudo subir o registrar
+        self.__on_registered = on_registered
+        self.__on_failed = on_failed
+        self.__batch_size = batch_size
+        self.__chunk_size = chunk_size
+        self.__max_attempts = max_attempts
+        self.__upload_slots = threading.BoundedSemaphore(max_uploads)
+        self.__condition = threading.Condition()
+        self.__uploading = 0
+        self.__registered = 0
+        self.__failed = 0
+        self.__uploads = queue.Queue(maxsize=max_queued)
+        self.__uploader = threading.Thread(target=self.__upload_products, daemon=True)
+        self.__uploader.start()
+        self.__registrations = queue.Queue(maxsize=max_pending_batches * batch_size)
+        self.__registrar = threading.Thread(target=self.__register_batches, daemon=True)
+        self.__registrar.start()
+
+    @property
+    def registered(self) -> int:
+        return self.__registered
+
+    @property
+    def failed(self) -> int:
+        return self.__failed
+
+    def submit(self, product_type, cie10, anio, ent_cve, mun_cve, sex_id, rate_type, response:dict) -> None:
+        # Se llama desde el hilo que recibe los resultados del pool de renderizado; solo encola el producto
+        with self.__condition:
+            self.__uploading += 1
+        self.__uploads.put(((product_type, cie10, anio, ent_cve, mun_cve, sex_id, rate_type), response))
+
+    def __upload_products(self) -> None:
+        while True:
+            item = self.__uploads.get()
+            if item is None:
+                return
+            product, response = item
+            self.__upload_slots.acquire()
+            futures, products = [], []
+            try:
+                prepare_indexing(*product, response, futures, products,
+                                 self.__mictlanx_url, self.__bucket_id, self.__observatory_id, self.__mictlanx_client,
+                                 self.__content_encoding)
+            except Exception as e:
+                print(f"Error al subir el producto {response.get('fname')}: {e}")
+                self.__finish_upload(products, response, False)
+                continue
+            uploads = {"pending": len(futures), "ok": True}
+            lock = threading.Lock()
+            def uploaded(future, products=products, response=response, uploads=uploads, lock=lock) -> None:
+                ok = future.exception() is None and future.result().is_ok
+                with lock:
+                    uploads["ok"] = uploads["ok"] and ok
+                    uploads["pending"] -= 1
+                    done = uploads["pending"] == 0
+                if done:
+                    self.__finish_upload(products, response, uploads["ok"])
+            for future in futures:
+                future.add_done_callback(uploaded)
+
+    def __finish_upload(self, products:list, response:dict, ok:bool) -> None:
+        # Con la cola de registro llena, bloquea aqui y la presion se propaga hasta submit
+        try:
+            if ok:
+                self.__registrations.put((products, response))
+            else:
+                self.__fail([response])
+        finally:
+            with self.__condition:
+                self.__uploading -= 1
+                self.__condition.notify_all()
+            self.__upload_slots.release()
+
+    def __register_batches(self) -> None:
+        batch = []
+        while True:
+            item = self.__registrations.get()
+            try:
+                if item is None or item is _FLUSH_REGISTRATIONS:
+                    batch, full_batch = [], batch
+                else:
+                    batch.append(item)
+                    full_batch = []
+                    if len(batch) >= self.__batch_size:
+                        batch, full_batch = [], batch
+                if full_batch:
+                    self.__register(full_batch)
+            except Exception as e:
+                # Un error no debe terminar el hilo: el lote completo se cuenta como fallido
+                print(f"Error al registrar {len(full_batch)} productos: {e}")
+                self.__fail([response for _, response in full_batch])
+            finally:
+                # Siempre se marca el elemento para que flush() no espere indefinidamente
+                self.__registrations.task_done()
+            if item is None:
+                return
+
+    def __register(self, batch:list) -> None:
+        # Los bloques se arman por producto para que sus registros (CSV y HTML) viajen siempre en la misma solicitud
+        chunks = [[product for products, _ in batch[start:start + self.__chunk_size] for product in products]
+                  for start in range(0, len(batch), self.__chunk_size)]
+        result = self.__oca_client.create_products_chunks(chunks=chunks, max_attempts=self.__max_attempts)
+        chunk_results = result.unwrap() if result.is_ok else result.unwrap_err().chunks
+        if result.is_err:
+            print(result.unwrap_err())
+        registered_chunks = {chunk.index for chunk in chunk_results if chunk.ok}
+        registered, failed = [], []
+        for position, (_, response) in enumerate(batch):
+            if position // self.__chunk_size in registered_chunks:
+                registered.append(response)
+            else:
+                failed.append(response)
+        confirmed = 0
+        for response in registered:
+            try:
+                if self.__on_registered is not None:
+                    self.__on_registered(response)
+                confirmed += 1
+            except Exception as e:
+                print(f"Error al confirmar un producto registrado: {e}")
+                failed.append(response)
+        with self.__condition:
+            self.__registered += confirmed
+        self.__fail(failed)
+
+    def __fail(self, responses:list) -> None:
+        with self.__condition:
+            self.__failed += len(responses)
+        if self.__on_failed is None:
+            return
+        for response in responses:
+            try:
+                self.__on_failed(response)
+            except Exception as e:
+                print(f"Error al descartar un producto fallido: {e}")
+
+    def flush(self) -> bool:
+        # Espera a que terminen las subidas en vuelo y se registre el ultimo lote; True si no hubo fallas
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__uploading == 0)
+        self.__registrations.put(_FLUSH_REGISTRATIONS)
+        self.__registrations.join()
+        return self.__failed == 0
+
+    def close(self) -> bool:
+        ok = self.flush()
+        self.__uploads.put(None)
+        self.__uploader.join()
+        self.__registrations.put(None)
+        self.__registrar.join()
+        return ok
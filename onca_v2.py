@@ -3,18 +3,13 @@ import onca_utils as ou
 import os
 import onca_products as op
 import numpy as np
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 import time
-import janitor
 import sys
 # Dependencias de MictlanX
 from mictlanx.logger.log import Log
 from mictlanx.v4.client import Client
 from mictlanx.utils.index import Utils
-from mictlanx.v4.interfaces.responses import PutResponse
 from concurrent.futures import as_completed
-from option import Result,Ok,Err
-from typing import List,Dict,Any,Awaitable
 from client import OCAClient
 from nanoid import generate as nanoid
 
@@ -26,230 +21,245 @@ input_cat_entidades = "./requirements/entidades_fed.csv"
 input_cat_municipios = "./requirements/municipios_geo.csv"
 input_cat_edades = "./requirements/EDADES.csv"
 input_mortality_folder = "./DATOS_CRUDOS/"
+input_deaths_store = "./DATOS_PARQUET/" # Se actualiza con los archivos nuevos o modificados de DATOS_CRUDOS
 input_estados_geojson = "./requirements/estados.geojson"
 cie10 = "C910"
 workers = 24
+render_in_flight = 4 * workers
+upload_in_flight = 4 * workers # Productos subiendose a MictlanX a la vez
+registration_batch_size = 250 # Productos por lote de registro en el OCA
+registration_chunk_size = 25 # Productos (CSV y HTML) por solicitud; los bloques de un lote se envian en paralelo
+rate_cache_max_bytes = 1024**3 # Limite de memoria del cache de tasas por rango de edad
+keep_local_copies = False # Los productos se suben desde memoria; True conserva tambien el HTML y CSV en output_path
+content_encoding = "gzip" # Precompresion de HTML y CSV ("gzip", "br" o None)
+geojson_tolerance = 0.005 # Tolerancia (grados) para simplificar la geometria de los mapas; None para la original
+
+# Todo el flujo va en main(): los procesos de renderizado (forkserver) importan este modulo como __mp_main__
+# y no deben volver a ejecutarlo
+def main():
+    output_path = f'/data/onca_products/{cie10}_outputs'
+    if not os.path.exists(output_path):
+        os.mkdir(output_path)
+
+    # Lectura de catalogos y datos crudos
+    print("Cargando catalogos")
+    catalog_loader = ou.CatalogLoader()
+
+    conapo_populations = catalog_loader.load_population_cube(input_conapo_poblaciones)
+    cat_entidades = catalog_loader.load_states(input_cat_entidades, compact=True)
+    cat_municipios = catalog_loader.load_municipalities(input_cat_municipios)
+    cat_edades = catalog_loader.load_ages(input_cat_edades)
+
+    del(catalog_loader)
+
+    print("Cargando registros de mortalidad")
+    death_loader = ou.DeathRegistryLoader()
+    death_loader.build_deaths_store(input_mortality_folder, input_deaths_store, workers=workers)
+    deaths = death_loader.load_deaths_from_store(input_deaths_store, cat_edades, cie10, compact=True)
+    del(death_loader)
+    deaths = deaths[(deaths.ANIO_REGIS >= 2000) & (deaths.ANIO_REGIS != 9999)]
+
+    if deaths.shape[0] == 0:
+        raise Exception(f"No se encontraron registros de mortalidad para {cie10}")
+
+    mc = ou.MortalityCalculator()
+
+    # Defunciones y poblacion por grupo de edad base; las tasas de cada rango de edades se obtienen de estos motores
+    # (ambos sexos se obtiene sumando los arreglos por sexo)
+    national_sex_engine = ou.AgeRangeEngine(deaths, conapo_populations, ['ANIO_REGIS', 'SEXO'])
+    national_engine = national_sex_engine.both_sexes()
+    state_sex_engine = ou.AgeRangeEngine(deaths, conapo_populations, ['ANIO_REGIS', 'ENT_CVE', 'SEXO'])
+    state_engine = state_sex_engine.both_sexes()
+
+    # Cada tasa por (causa, rango de edades, agrupacion) se calcula una sola vez aunque la usen varios productos
+    rate_cache = ou.MortalityRateCache(mc, conapo_populations, max_bytes=rate_cache_max_bytes)
+    for engine in (national_sex_engine, national_engine, state_sex_engine, state_engine):
+        rate_cache.register_engine(cie10, engine)
+
+    # Variacion de rangos de edad
+    age_groups = np.array(['00_04', '05_09', '10_14', '15_19', '20_24', '25_29', '30_34',
+           '35_39', '40_44', '45_49', '50_54', '55_59', '60_64', '65_69',
+           '70_74', '75_79', '80_84', '>85'])
+    arr_l = age_groups.shape[0]
+
+    init_time = time.time()
+
+    #Definiendo las configuraciones de MictlanX
+    print("Definiendo las configuraciones de MictlanX")
+    oca_client = OCAClient(
+        hostname=os.environ.get("OCA_API_HOSTNAME","apix.tamps.cinvestav.mx/onca/api/v1"),
+        port= int(os.environ.get("OCA_API_PORT","-1")),
+    )
 
-output_path = f'/data/onca_products/{cie10}_outputs'
-if not os.path.exists(output_path):
-    os.mkdir(output_path)
-
-# Lectura de catalogos y datos crudos
-print("Cargando catalogos")
-catalog_loader = ou.CatalogLoader()
-
-conapo_populations = catalog_loader.load_conapo_populations(input_conapo_poblaciones)
-cat_entidades = catalog_loader.load_states(input_cat_entidades)
-cat_municipios = catalog_loader.load_municipalities(input_cat_municipios)
-cat_edades = catalog_loader.load_ages(input_cat_edades)
-
-del(catalog_loader)
-
-print("Cargando registros de mortalidad")
-deaths = ou.DeathRegistryLoader().load_deaths(input_mortality_folder, cat_edades, cie10)
-deaths = deaths[(deaths.ANIO_REGIS >= 2000) & (deaths.ANIO_REGIS != 9999)]
-
-if deaths.shape[0] == 0:
-    raise Exception(f"No se encontraron registros de mortalidad para {cie10}")
-
-mc = ou.MortalityCalculator()
-pg = op.ProductGenerator()
-
-# Variacion de rangos de edad
-age_groups = np.array(['00_04', '05_09', '10_14', '15_19', '20_24', '25_29', '30_34',
-       '35_39', '40_44', '45_49', '50_54', '55_59', '60_64', '65_69',
-       '70_74', '75_79', '80_84', '>85'])
-arr_l = age_groups.shape[0]
-
-init_time = time.time()
-
-#Definiendo las configuraciones de MictlanX
-print("Definiendo las configuraciones de MictlanX")
-oca_client = OCAClient(
-    hostname=os.environ.get("OCA_API_HOSTNAME","apix.tamps.cinvestav.mx/onca/api/v1"),
-    port= int(os.environ.get("OCA_API_PORT","-1")),
-)
-
-L = Log(
-    name     = "upload_metadata",
-    path     = "logs/",
-    console_handler_filter=lambda record: True
-)
-
-MICTLANX_BUCKET_ID = "c910_test14" # productos en espanol
-# MICTLANX_BUCKET_ID = "c910_test13" # productos en espanol (problemas de registro) BORRADO
-# MICTLANX_BUCKET_ID = "c910_test12" # productos en espanol BORRADO?
-# MICTLANX_BUCKET_ID = "c910_test11" # solamente para mapas estatales
-# MICTLANX_BUCKET_ID = "c910_test10" # solamente para mapas estatales (problema de memoria)
-# MICTLANX_BUCKET_ID = "c910_test9" # prueba con conexion por ethernet solo boxplots BORRADO?
-# MICTLANX_BUCKET_ID = "c910_test8" # Solo faltan mapas aqui
-# MICTLANX_BUCKET_ID = "c910_test7" BORRADO
-# MICTLANX_BUCKET_ID = "c910_test6" BORRADO
-# MICTLANX_BUCKET_ID = "c910_test5" BORRADO
-# MICTLANX_BUCKET_ID = "c910_test4" BORRADO
-
-NODE_ID = os.environ.get("NODE_ID","risk-calculator-observatory-0")
-BUCKET_ID       = os.environ.get("MICTLANX_BUCKET_ID",MICTLANX_BUCKET_ID) #pruebas
-catalog_ids = os.environ.get("OBSERVATORY_CATALOGS","").split(';')
-routers_str = os.environ.get("MICTLANX_ROUTERS","mictlanx-router-0:apix.tamps.cinvestav.mx/mictlanx:-1") #
-
-OBSERVATORY_ID     = os.environ.get("OBSERVATORY_ID",MICTLANX_BUCKET_ID)
-MICTLANX_URL       = os.environ.get("MICTLANX_URL","https://apix.tamps.cinvestav.mx/mictlanx/api/v4/buckets")
-
-
-MICTLANX_PROTOCOL  = os.environ.get("MICTLANX_PROTOCOL","https")
-OUTPUT_PATH:str    = os.environ.get("OUTPUT_PATH","outs_csv/")
-L.debug({
-    "event":"RETC_IARC_STARTED",
-    "bucket_id":BUCKET_ID,
-    "catalog_ids":catalog_ids,
-    "routers_str":routers_str
-})
-
-print("Iniciando el cliente de MictlanX")
-routers     = list(Utils.routers_from_str(routers_str,protocol=MICTLANX_PROTOCOL))
-c = Client(
-    # Unique identifier of the client
-    client_id   = os.environ.get("MICTLANX_CLIENT_ID","risk-calculator-0"),
-    # Storage peers
-    routers     = routers,
-    # Number of threads to perform I/O operations
-    max_workers = int(os.environ.get("MICTLANX_MAX_WORKERS","2")),
-    # This parameters are optionals only set to True if you want to see some basic metrics ( this options increase little bit the overhead please take into account).
-    debug       = True,
-    log_output_path= os.environ.get("MICTLANX_LOG_OUTPUT_PATH","logs/"),
-    bucket_id=BUCKET_ID
-)
-
-
-#----------------LINEPLOTS----------------#
-print("Generando lineplots")
-
-products = []
-futures:List[Awaitable[Result[PutResponse,Exception]]] = []
-
-if not os.path.exists(output_path + '/lineplots'):
-    os.mkdir(output_path + '/lineplots')
-counter = 1
-for l in np.arange(arr_l) + 1:   
-    for i in np.arange(arr_l-l+1):
-        age_groups_range = age_groups[i:i+l]
-        filtered_deaths = deaths[deaths.RANGO_EDAD.isin(age_groups_range)].copy()
-
-        init_age = age_groups_range[0].split('_')[0]
-        end_age = age_groups_range[-1].split('_')[-1]
-
-        if init_age == '>85' and end_age == '>85':
-            ages = 'mas85'
-        elif end_age == '>85':
-            ages = f"{init_age}-mas85"
-        else:
-            ages = f"{init_age}-{end_age}"
-
-        # for sex_id, sex in zip([1,2,3], ["Men","Women","Both sexes"]):
-        for sex_id, sex in zip([1,2,3], ["Hombres","Mujeres","Ambos sexos"]):
-            # for tasa, escala in zip(["TASA_CRUDA_1K","TASA_CRUDA_10K","TASA_CRUDA_100K"], ["1000","10,000","100,000"]):
-            tasa = "TASA_CRUDA_100K"
-            escala = "100,000"
-            if sex_id == 3:
-                df = mc.compute_raw_mortality_rate(filtered_deaths, conapo_populations, ['ANIO_REGIS', 'RANGO_EDAD'])
-            else:
-                df = mc.compute_raw_mortality_rate(filtered_deaths, conapo_populations, ['ANIO_REGIS', 'SEXO', 'RANGO_EDAD'])
-                df = df[df.SEXO == sex_id].drop(columns=["SEXO"])
-
-            response = pg.create_lineplot(
-                data=df,
-                x='ANIO_REGIS',
-                y=tasa,
-                color='RANGO_EDAD',
-                output_path=output_path + '/lineplots',
-                cie10=cie10,
-                place='México',
-                scale=escala,
-                hover_data= [tasa],
-                labels={'ANIO_REGIS':'Año', 'RANGO_EDAD':'Grupo de edad', tasa:'Tasa de mortalidad específica por edad'},
-                cve_geo='00',
-                sex=sex,
-                ages=ages
-            )
-            
-            ou.prepare_indexing("Lineplot",
-                                cie10,
-                                "2000-2023",
-                                "00",
-                                "000",
-                                sex_id,
-                                tasa,
-                                response,
-                                futures,
-                                products,
-                                MICTLANX_URL,
-                                BUCKET_ID,
-                                OBSERVATORY_ID,
-                                c)
-
-            print(f"Lineplot {counter}")#, end="\r")
-            counter+=1
-
-wait(futures)
-
-prod_res    = oca_client.create_products(
-        products = products
+    L = Log(
+        name     = "upload_metadata",
+        path     = "logs/",
+        console_handler_filter=lambda record: True
     )
-print(prod_res)
-del(products, futures)
-
-#----------------HEATMAPS----------------#
-print("Generando mapas de calor")
-
-products = []
-futures:List[Awaitable[Result[PutResponse,Exception]]] = []
-
-if not os.path.exists(output_path + '/heatmaps'):
-    os.mkdir(output_path + '/heatmaps')
-counter = 0
-for l in np.arange(arr_l) + 1:   
-    for i in np.arange(arr_l-l+1):
-        age_groups_range = age_groups[i:i+l]
-        filtered_deaths = deaths[deaths.RANGO_EDAD.isin(age_groups_range)].copy()
-        # ages = f"{age_groups_range[0].split('_')[0]}-{age_groups_range[-1].split('_')[-1]}"
-        init_age = age_groups_range[0].split('_')[0]
-        end_age = age_groups_range[-1].split('_')[-1]
-
-        if init_age == '>85' and end_age == '>85':
-            ages = 'mas85'
-        elif end_age == '>85':
-            ages = f"{init_age}-mas85"
-        else:
-            ages = f"{init_age}-{end_age}"
-
-        # for sex_id, sex in zip([1,2,3], ["Men","Women","Both sexes"]):
-        for sex_id, sex in zip([1,2,3], ["Hombres","Mujeres","Ambos sexos"]):
-            # for tasa, escala in zip(["TASA_CRUDA_1K","TASA_CRUDA_10K","TASA_CRUDA_100K"], ["1000","10,000","100,000"]):
-            tasa = "TASA_CRUDA_100K"
-            escala = "100,000"
-            if sex_id == 3:
-                df = mc.compute_raw_mortality_rate(filtered_deaths, conapo_populations, ['ANIO_REGIS', 'ENT_CVE', 'RANGO_EDAD'])
-            else:
-                df = mc.compute_raw_mortality_rate(filtered_deaths, conapo_populations, ['ANIO_REGIS', 'ENT_CVE', 'SEXO', 'RANGO_EDAD'])
-                df = df[df.SEXO == sex_id].drop(columns=["SEXO"])
 
-            df = df.merge(cat_entidades, on="ENT_CVE")
-            df = df.astype({'ENT_CVE':str})
-            df['ENT_CVE'] = df.ENT_CVE.str.zfill(2)
+    MICTLANX_BUCKET_ID = "c910_test14" # productos en espanol
+    # MICTLANX_BUCKET_ID = "c910_test13" # productos en espanol (problemas de registro) BORRADO
+    # MICTLANX_BUCKET_ID = "c910_test12" # productos en espanol BORRADO?
+    # MICTLANX_BUCKET_ID = "c910_test11" # solamente para mapas estatales
+    # MICTLANX_BUCKET_ID = "c910_test10" # solamente para mapas estatales (problema de memoria)
+    # MICTLANX_BUCKET_ID = "c910_test9" # prueba con conexion por ethernet solo boxplots BORRADO?
+    # MICTLANX_BUCKET_ID = "c910_test8" # Solo faltan mapas aqui
+    # MICTLANX_BUCKET_ID = "c910_test7" BORRADO
+    # MICTLANX_BUCKET_ID = "c910_test6" BORRADO
+    # MICTLANX_BUCKET_ID = "c910_test5" BORRADO
+    # MICTLANX_BUCKET_ID = "c910_test4" BORRADO
+
+    NODE_ID = os.environ.get("NODE_ID","risk-calculator-observatory-0")
+    BUCKET_ID       = os.environ.get("MICTLANX_BUCKET_ID",MICTLANX_BUCKET_ID) #pruebas
+    catalog_ids = os.environ.get("OBSERVATORY_CATALOGS","").split(';')
+    routers_str = os.environ.get("MICTLANX_ROUTERS","mictlanx-router-0:apix.tamps.cinvestav.mx/mictlanx:-1") #
+
+    OBSERVATORY_ID     = os.environ.get("OBSERVATORY_ID",MICTLANX_BUCKET_ID)
+    MICTLANX_URL       = os.environ.get("MICTLANX_URL","https://apix.tamps.cinvestav.mx/mictlanx/api/v4/buckets")
+
+
+    MICTLANX_PROTOCOL  = os.environ.get("MICTLANX_PROTOCOL","https")
+    OUTPUT_PATH:str    = os.environ.get("OUTPUT_PATH","outs_csv/")
+    L.debug({
+        "event":"RETC_IARC_STARTED",
+        "bucket_id":BUCKET_ID,
+        "catalog_ids":catalog_ids,
+        "routers_str":routers_str
+    })
+
+    print("Iniciando el cliente de MictlanX")
+    routers     = list(Utils.routers_from_str(routers_str,protocol=MICTLANX_PROTOCOL))
+    c = Client(
+        # Unique identifier of the client
+        client_id   = os.environ.get("MICTLANX_CLIENT_ID","risk-calculator-0"),
+        # Storage peers
+        routers     = routers,
+        # Number of threads to perform I/O operations
+        max_workers = int(os.environ.get("MICTLANX_MAX_WORKERS","2")),
+        # This parameters are optionals only set to True if you want to see some basic metrics ( this options increase little bit the overhead please take into account).
+        debug       = True,
+        log_output_path= os.environ.get("MICTLANX_LOG_OUTPUT_PATH","logs/"),
+        bucket_id=BUCKET_ID
+    )
+
+    # Todos los productos HTML referencian una sola copia de plotly.js en el bucket en lugar de incrustarla
+    print("Subiendo plotly.js al bucket")
+    plotlyjs_url = ou.upload_plotlyjs(c, MICTLANX_URL, BUCKET_ID)
+    render_options = dict(geojson_tolerance=geojson_tolerance,
+                          plotlyjs_url=plotlyjs_url,
+                          use_templates=True,
+                          in_memory=True,
+                          write_files=keep_local_copies,
+                          content_encoding=content_encoding)
+    # Los productos se renderizan en procesos; cada uno carga el GeoJSON y arma sus plantillas una vez
+    render_pool = op.ProductRenderPool(workers, geojson_paths=[input_estados_geojson], **render_options)
+    # Los productos cuyos datos y parametros no cambiaron desde la ultima corrida no se renderizan ni se suben.
+    # La sal solo lleva lo que cambia los artefactos subidos (las plantillas, in_memory y write_files no) y su destino
+    render_cache = op.RenderCache(output_path + "/render_cache.json",
+                                  salt=dict(geojson_tolerance=geojson_tolerance,
+                                            plotlyjs_url=plotlyjs_url,
+                                            content_encoding=content_encoding,
+                                            bucket_id=BUCKET_ID,
+                                            observatory_id=OBSERVATORY_ID))
+    # Un solo planificador para todas las etapas; cada producto se indexa en cuanto termina de renderizarse
+    scheduler = op.RenderScheduler(render_pool, max_in_flight=render_in_flight, render_cache=render_cache)
+
+    # Subida y registro en flujo continuo con colas acotadas; un producto se confirma en el cache al quedar registrado
+    # y se descarta del cache si no se pudo subir o registrar
+    pipeline = ou.IndexingPipeline(c, oca_client, MICTLANX_URL, BUCKET_ID, OBSERVATORY_ID,
+                                   max_uploads=upload_in_flight,
+                                   max_queued=render_in_flight,
+                                   batch_size=registration_batch_size,
+                                   chunk_size=registration_chunk_size,
+                                   on_registered=lambda response: render_cache.confirm(response["render_key"]),
+                                   on_failed=lambda response: render_cache.forget(response["render_key"]))
+
+    def indexing_callback(product_type: str, year, sex_id: int, tasa: str):
+        return lambda response: pipeline.submit(product_type, cie10, year, "00", "000", sex_id, tasa, response)
+
+
+    #----------------LINEPLOTS----------------#
+    print("Generando lineplots")
+
+    if not os.path.exists(output_path + '/lineplots'):
+        os.mkdir(output_path + '/lineplots')
+    counter = 1
+    for l in np.arange(arr_l) + 1:   
+        for i in np.arange(arr_l-l+1):
+            age_groups_range = age_groups[i:i+l]
+
+            ages = ou.age_range_label(age_groups_range)
+
+            # for sex_id, sex in zip([1,2,3], ["Men","Women","Both sexes"]):
+            for sex_id, sex in zip([1,2,3], ["Hombres","Mujeres","Ambos sexos"]):
+                # for tasa, escala in zip(["TASA_CRUDA_1K","TASA_CRUDA_10K","TASA_CRUDA_100K"], ["1000","10,000","100,000"]):
+                tasa = "TASA_CRUDA_100K"
+                escala = "100,000"
+                if sex_id == 3:
+                    df = rate_cache.compute_raw_mortality_rate(cie10, deaths, age_groups_range, ['ANIO_REGIS', 'RANGO_EDAD'])
+                else:
+                    df = rate_cache.compute_raw_mortality_rate(cie10, deaths, age_groups_range, ['ANIO_REGIS', 'SEXO', 'RANGO_EDAD'])
+                    df = df[df.SEXO == sex_id].drop(columns=["SEXO"])
+
+                scheduler.submit("create_lineplot",
+                    callback=indexing_callback("Lineplot", "2000-2023", sex_id, tasa),
+                    data=df,
+                    x='ANIO_REGIS',
+                    y=tasa,
+                    color='RANGO_EDAD',
+                    output_path=output_path + '/lineplots',
+                    cie10=cie10,
+                    place='México',
+                    scale=escala,
+                    hover_data= [tasa],
+                    labels={'ANIO_REGIS':'Año', 'RANGO_EDAD':'Grupo de edad', tasa:'Tasa de mortalidad específica por edad'},
+                    cve_geo='00',
+                    sex=sex,
+                    ages=ages
+                )
 
+                print(f"Lineplot {counter}")#, end="\r")
+                counter+=1
 
-            with ThreadPoolExecutor(max_workers=workers) as executor:
-                fts = list()
-                years = list()
-                for year in df.ANIO_REGIS.unique():
-                    years.append(year)
-                    df_year = df[df.ANIO_REGIS == year].copy()
-                    df_cancer_c = df_year.complete("ENT_NOMBRE","RANGO_EDAD").fillna(0)
-                    df_cancer_c = df_cancer_c.sort_values(by=[tasa], ascending=False)
+    render_cache.save() # Productos ya registrados; subidas y registros siguen en curso
+
+    #----------------HEATMAPS----------------#
+    print("Generando mapas de calor")
+
+    if not os.path.exists(output_path + '/heatmaps'):
+        os.mkdir(output_path + '/heatmaps')
+    counter = 0
+    for l in np.arange(arr_l) + 1:   
+        for i in np.arange(arr_l-l+1):
+            age_groups_range = age_groups[i:i+l]
+            # ages = f"{age_groups_range[0].split('_')[0]}-{age_groups_range[-1].split('_')[-1]}"
+            ages = ou.age_range_label(age_groups_range)
+
+            # for sex_id, sex in zip([1,2,3], ["Men","Women","Both sexes"]):
+            for sex_id, sex in zip([1,2,3], ["Hombres","Mujeres","Ambos sexos"]):
+                # for tasa, escala in zip(["TASA_CRUDA_1K","TASA_CRUDA_10K","TASA_CRUDA_100K"], ["1000","10,000","100,000"]):
+                tasa = "TASA_CRUDA_100K"
+                escala = "100,000"
+                if sex_id == 3:
+                    df = rate_cache.compute_raw_mortality_rate(cie10, deaths, age_groups_range, ['ANIO_REGIS', 'ENT_CVE', 'RANGO_EDAD'])
+                else:
+                    df = rate_cache.compute_raw_mortality_rate(cie10, deaths, age_groups_range, ['ANIO_REGIS', 'ENT_CVE', 'SEXO', 'RANGO_EDAD'])
+                    df = df[df.SEXO == sex_id].drop(columns=["SEXO"])
+
+                df = df.merge(cat_entidades, on="ENT_CVE")
+                df = df.astype({'ENT_CVE':str})
+                df['ENT_CVE'] = df.ENT_CVE.str.zfill(2)
+
+
+                # Malla completa año x estado x grupo de edad en un solo reindex, ordenada por año y tasa:
+                # cada año es un bloque contiguo que se entrega al generador como vista, sin copiar ni reordenar
+                grid = ou.complete_grid(df, [['ANIO_REGIS'], ['ENT_CVE','ENT_NOMBRE'], ['RANGO_EDAD']])
+                grid = grid.sort_values(['ANIO_REGIS', tasa], ascending=[True, False], kind='stable', ignore_index=True)
+                for year, df_cancer_c in ou.PartitionedFrame(grid, 'ANIO_REGIS', presorted=True):
                     counter+=1
-                    
-                    fts.append(executor.submit(pg.create_age_specific_heatmap,
+
+                    scheduler.submit("create_age_specific_heatmap",
+                    callback=indexing_callback("Heatmap", year, sex_id, tasa),
                     data=df_cancer_c,
                     x="ENT_NOMBRE",
                     y="RANGO_EDAD",
@@ -265,84 +275,44 @@ for l in np.arange(arr_l) + 1:
                     cve_geo='00',
                     sex=sex,
                     ages=ages,
-                    year=year))
-                    
+                    year=year)
+
                     print(f"Heatmap {counter}")#, end="\r")
 
-                for ft, year in zip(fts, years):
-                    response = ft.result()
-
-                    ou.prepare_indexing("Heatmap",
-                                        cie10,
-                                        year,
-                                        "00",
-                                        "000",
-                                        sex_id,
-                                        tasa,
-                                        response,
-                                        futures,
-                                        products,
-                                        MICTLANX_URL,
-                                        BUCKET_ID,
-                                        OBSERVATORY_ID,
-                                        c)
-
-wait(futures)
-
-prod_res    = oca_client.create_products(
-        products = products
-    )
-print(prod_res)
-del(products, futures)
-
-#----------------BOXPLOTS----------------#
-print("Generando boxplots")
-
-products = []
-futures:List[Awaitable[Result[PutResponse,Exception]]] = []
-
-if not os.path.exists(output_path + '/boxplots'):
-    os.mkdir(output_path + '/boxplots')
-counter = 0
-for l in np.arange(arr_l) + 1:   
-    for i in np.arange(arr_l-l+1):
-        age_groups_range = age_groups[i:i+l]
-        filtered_deaths = deaths[deaths.RANGO_EDAD.isin(age_groups_range)].copy()
-        # ages = f"{age_groups_range[0].split('_')[0]}-{age_groups_range[-1].split('_')[-1]}"
-        init_age = age_groups_range[0].split('_')[0]
-        end_age = age_groups_range[-1].split('_')[-1]
-
-        if init_age == '>85' and end_age == '>85':
-            ages = 'mas85'
-        elif end_age == '>85':
-            ages = f"{init_age}-mas85"
-        else:
-            ages = f"{init_age}-{end_age}"
-        
-
-        # sex = "Both sexes"
-        sex = "Ambos sexos"
-        # for tasa, escala in zip(["TASA_CRUDA_1K","TASA_CRUDA_10K","TASA_CRUDA_100K"], ["1000","10,000","100,000"]):
-        tasa = "TASA_CRUDA_100K"
-        escala = "100,000"
-        df = mc.compute_raw_mortality_rate(filtered_deaths, conapo_populations, ['ANIO_REGIS', 'ENT_CVE', 'SEXO', 'RANGO_EDAD'])
-        df = df.merge(cat_entidades, on="ENT_CVE")
-        df = df.astype({'ENT_CVE':str,'SEXO':str})
-        df.loc[df.SEXO=="1","SEXO"] = "Hombres"
-        df.loc[df.SEXO=="2","SEXO"] = "Mujeres"
-        df['ENT_CVE'] = df.ENT_CVE.str.zfill(2)
-
-
-        with ThreadPoolExecutor(max_workers=workers) as executor:
-            fts = list()
-            years = list()
-            for year in df.ANIO_REGIS.unique():
-                years.append(year)
-                df_year = df[df.ANIO_REGIS == year].copy()
-                df_year = df_year.sort_values(['RANGO_EDAD','SEXO'])
+    render_cache.save() # Productos ya registrados; subidas y registros siguen en curso
+
+    #----------------BOXPLOTS----------------#
+    print("Generando boxplots")
+
+    if not os.path.exists(output_path + '/boxplots'):
+        os.mkdir(output_path + '/boxplots')
+    counter = 0
+    for l in np.arange(arr_l) + 1:   
+        for i in np.arange(arr_l-l+1):
+            age_groups_range = age_groups[i:i+l]
+            # ages = f"{age_groups_range[0].split('_')[0]}-{age_groups_range[-1].split('_')[-1]}"
+            ages = ou.age_range_label(age_groups_range)
+
+
+            # sex = "Both sexes"
+            sex = "Ambos sexos"
+            # for tasa, escala in zip(["TASA_CRUDA_1K","TASA_CRUDA_10K","TASA_CRUDA_100K"], ["1000","10,000","100,000"]):
+            tasa = "TASA_CRUDA_100K"
+            escala = "100,000"
+            df = rate_cache.compute_raw_mortality_rate(cie10, deaths, age_groups_range, ['ANIO_REGIS', 'ENT_CVE', 'SEXO', 'RANGO_EDAD'])
+            df = df.merge(cat_entidades, on="ENT_CVE")
+            df = df.astype({'ENT_CVE':str,'SEXO':str})
+            df.loc[df.SEXO=="1","SEXO"] = "Hombres"
+            df.loc[df.SEXO=="2","SEXO"] = "Mujeres"
+            df['ENT_CVE'] = df.ENT_CVE.str.zfill(2)
+
+
+            # Un solo ordenamiento por año (y edad/sexo dentro de cada año); cada año se entrega como vista
+            for year, df_year in ou.PartitionedFrame(df, 'ANIO_REGIS', order_by=['RANGO_EDAD','SEXO']):
                 counter+=1
-                
-                fts.append(executor.submit(pg.create_boxplot,
+
+                scheduler.submit("create_boxplot",
+                callback=indexing_callback("Boxplot", year, 3, tasa),
                 data=df_year,
                 x='RANGO_EDAD',
                 y=tasa,
@@ -359,102 +329,56 @@ for l in np.arange(arr_l) + 1:
                 cve_geo='00',
                 sex=sex,
                 ages=ages,
-                year=year))
-                
-                print(f"Boxplot {counter}")#, end="\r")
-
-            for ft, year in zip(fts, years):
-                response = ft.result()
-
-                ou.prepare_indexing("Boxplot",
-                                    cie10,
-                                    year,
-                                    "00",
-                                    "000",
-                                    3,
-                                    tasa,
-                                    response,
-                                    futures,
-                                    products,
-                                    MICTLANX_URL,
-                                    BUCKET_ID,
-                                    OBSERVATORY_ID,
-                                    c)
-
-wait(futures)
-
-prod_res    = oca_client.create_products(
-        products = products
-    )
-print(prod_res)
-del(products, futures)
-
-#-----------MAPAS ESTATALES---------------#
-print("\nGenerando mapas estatales")
+                year=year)
 
-if not os.path.exists(output_path + '/maps'):
-    os.mkdir(output_path + '/maps')
-counter = 1
-
-for l in np.arange(arr_l) + 1:   
-    for i in np.arange(arr_l-l+1):
-
-        products = []
-        futures:List[Awaitable[Result[PutResponse,Exception]]] = []
-
-        age_groups_range = age_groups[i:i+l]
-        filtered_deaths = deaths[deaths.RANGO_EDAD.isin(age_groups_range)].copy()
-        # ages = f"{age_groups_range[0].split("_")[0]}-{age_groups_range[-1].split("_")[-1]}"
-        init_age = age_groups_range[0].split('_')[0]
-        end_age = age_groups_range[-1].split('_')[-1]
-
-        if init_age == '>85' and end_age == '>85':
-            ages = 'mas85'
-        elif end_age == '>85':
-            ages = f"{init_age}-mas85"
-        else:
-            ages = f"{init_age}-{end_age}"
-
-        # for sex_id, sex in zip([1,2,3], ["Men","Women","Both sexes"]):
-        for sex_id, sex in zip([1,2,3], ["Hombres","Mujeres","Ambos sexos"]):
-            # for tasa, escala in zip(["TASA_CRUDA_1K","TASA_CRUDA_10K","TASA_CRUDA_100K"], ["1000","10,000","100,000"]):
-            tasa = "TASA_CRUDA_100K"
-            escala = "100,000"
-            who = ou.MortalityStandardizer(file_path=input_who_poblaciones, std_name='WHO', age_groups=age_groups_range)
-
-            if sex_id == 3:
-                df = mc.compute_raw_mortality_rate(filtered_deaths, conapo_populations, ['ANIO_REGIS', 'ENT_CVE', 'RANGO_EDAD'])
-                
-                df = who.compute_ASR(df=df[['ANIO_REGIS', 'ENT_CVE', 'RANGO_EDAD',tasa]],
-                    age_column="RANGO_EDAD",
-                    rate_column=tasa,
-                    scale="100K")
-                
-            else:
-                # df = mc.compute_raw_mortality_rate(filtered_deaths[filtered_deaths.SEXO == sex_id], conapo_populations, ['ANIO_REGIS', 'ENT_CVE', 'SEXO', 'RANGO_EDAD'])
-                df = mc.compute_raw_mortality_rate(filtered_deaths, conapo_populations, ['ANIO_REGIS', 'ENT_CVE', 'SEXO', 'RANGO_EDAD'])
-                df = df[df.SEXO == sex_id].drop(columns=["SEXO"])
-
-                # df = who.compute_ASR(df=df[['ANIO_REGIS', 'ENT_CVE', 'SEXO', 'RANGO_EDAD','TASA_CRUDA_100K']],
-                df = who.compute_ASR(df=df[['ANIO_REGIS', 'ENT_CVE', 'RANGO_EDAD',tasa]],
-                    age_column="RANGO_EDAD",
-                    rate_column=tasa,
-                    scale="100K")
-                
-            tasa = "ASR(WHO)_100K"
-            df = df.merge(cat_entidades, on="ENT_CVE")
-            df = df.astype({'ENT_CVE':str})
-            df['ENT_CVE'] = df.ENT_CVE.str.zfill(2)
+                print(f"Boxplot {counter}")#, end="\r")
 
-            with ThreadPoolExecutor(max_workers=workers) as executor:
-                fts = list()
-                years = list()
-                for year in df.ANIO_REGIS.unique():
-                    years.append(year)
-                    df_year = df[df.ANIO_REGIS == year].copy()
+    render_cache.save() # Productos ya registrados; subidas y registros siguen en curso
+
+    #-----------MAPAS ESTATALES---------------#
+    print("\nGenerando mapas estatales")
+
+    if not os.path.exists(output_path + '/maps'):
+        os.mkdir(output_path + '/maps')
+    counter = 1
+
+    # Tasas estandarizadas (OMS) de todos los rangos de edad, estados y años en un solo calculo
+    who = ou.MortalityStandardizer(file_path=input_who_poblaciones, std_name='WHO', age_groups=age_groups)
+    state_asr = dict(tuple(state_engine.range_ASR(who, "TASA_CRUDA_100K", "100K").groupby('EDADES', sort=False)))
+    state_sex_asr = dict(tuple(state_sex_engine.range_ASR(who, "TASA_CRUDA_100K", "100K").groupby('EDADES', sort=False)))
+
+    for l in np.arange(arr_l) + 1:   
+        for i in np.arange(arr_l-l+1):
+            age_groups_range = age_groups[i:i+l]
+            # ages = f"{age_groups_range[0].split("_")[0]}-{age_groups_range[-1].split("_")[-1]}"
+            ages = ou.age_range_label(age_groups_range)
+
+            # for sex_id, sex in zip([1,2,3], ["Men","Women","Both sexes"]):
+            for sex_id, sex in zip([1,2,3], ["Hombres","Mujeres","Ambos sexos"]):
+                # for tasa, escala in zip(["TASA_CRUDA_1K","TASA_CRUDA_10K","TASA_CRUDA_100K"], ["1000","10,000","100,000"]):
+                tasa = "TASA_CRUDA_100K"
+                escala = "100,000"
+
+                # Sin defunciones en este rango de edades; ambos sexos puede tener registros (SEXO 9) aunque no haya por sexo
+                rates = state_asr if sex_id == 3 else state_sex_asr
+                if ages not in rates:
+                    continue
+                if sex_id == 3:
+                    df = state_asr[ages].drop(columns=["EDADES"])
+                else:
+                    df = state_sex_asr[ages]
+                    df = df[df.SEXO == sex_id].drop(columns=["EDADES", "SEXO"])
+
+                tasa = "ASR(WHO)_100K"
+                df = df.merge(cat_entidades, on="ENT_CVE")
+                df = df.astype({'ENT_CVE':str})
+                df['ENT_CVE'] = df.ENT_CVE.str.zfill(2)
+
+                for year, df_year in ou.PartitionedFrame(df, 'ANIO_REGIS'):
                     counter+=1
 
-                    fts.append(executor.submit(pg.create_state_map,
+                    scheduler.submit("create_state_map",
+                        callback=indexing_callback("Map", year, sex_id, tasa.replace('(','').replace(')','')),
                         data=df_year,
                         # data=df.query(f"ANIO_REGIS == {year}"),
                         geojson_file_path=input_estados_geojson,
@@ -471,34 +395,18 @@ for l in np.arange(arr_l) + 1:
                         cve_geo='00',
                         sex=sex,
                         ages=ages,
-                        year=year))
+                        year=year)
 
                     print(f"State map {counter}")#, end="\r")
 
-                for ft, year in zip(fts, years):
-                    response = ft.result()
-
-                    ou.prepare_indexing("Map",
-                                        cie10,
-                                        year,
-                                        "00",
-                                        "000",
-                                        sex_id,
-                                        tasa.replace('(','').replace(')',''),
-                                        response,
-                                        futures,
-                                        products,
-                                        MICTLANX_URL,
-                                        BUCKET_ID,
-                                        OBSERVATORY_ID,
-                                        c)
-
-        wait(futures)
-
-        prod_res    = oca_client.create_products(
-                products = products
-            )
-        print(prod_res)
-        del(products, futures)
-
-print(f"\nProductos terminados en {round((time.time()-init_time)/60,2)} minutos")
\ No newline at end of file
+    scheduler.wait()
+    if not pipeline.close():
+        print(f"Productos con fallas de subida o registro: {pipeline.failed}")
+    render_cache.save()
+
+    render_pool.shutdown()
+    print(f"Productos sin cambios omitidos: {render_cache.hits}")
+    print(f"\nProductos terminados en {round((time.time()-init_time)/60,2)} minutos")
+
+if __name__ == "__main__":
+    main()